@@ -0,0 +1,146 @@
+import numpy as np
+import cv2
+
+import Calibration
+import Dtypes
+
+
+class Background:
+    # streaming background model: per pixel exponential mean and variance of the depth,
+    # updated every update_interval frames with the current foreground masked out.
+    # image is the eroded separation threshold used by Processors.process_images, dirty the
+    # rectangles (y0, y1, x0, x1) of it changed by the last update, None for all of it.
+
+    kernel_size = 5
+    iter = 4
+    tile = 16
+
+    def __init__(self, conf):
+        self.h, self.w = conf.img_h, conf.img_w
+        self.compression = conf.sampling_reduction
+        self.clipping_tolerance = conf.clipping_tolerance
+        self.alpha = conf.bg_alpha
+        self.sigmas = conf.bg_sigmas
+        self.update_interval = conf.bg_update_interval
+        self.deadband = conf.bg_deadband
+        # erosion with a square kernel, iterated, reaches this far
+        self.radius = (self.kernel_size // 2) * self.iter
+        self.kernel = np.ones((self.kernel_size, self.kernel_size), np.uint8)
+
+        self.roi = Calibration.full_roi(self.h, self.w)
+        self.allocate()
+
+        self.framecount = 0
+        self.updates = 0
+        self.valid = False
+        self.dirty = None
+
+    def allocate(self):
+        shape = Calibration.crop_shape(self.roi, self.compression)
+        self.mean = np.zeros(shape, np.float32)
+        self.var = np.zeros(shape, np.float32)
+        self.raw = np.zeros(shape, np.uint16)
+        self.image = np.zeros(shape, np.uint16)
+
+        # scratch buffers
+        self.depth = np.zeros(shape, np.float32)
+        self.diff = np.zeros(shape, np.float32)
+        self.threshold = np.zeros(shape, np.float32)
+        self.next_raw = np.zeros(shape, np.uint16)
+        self.step = np.zeros(shape, np.float32)
+        self.learn = np.zeros(shape, bool)
+        self.changed = np.zeros(shape, bool)
+        self.tile_rows = np.arange(0, shape[0], self.tile)
+        self.tile_cols = np.arange(0, shape[1], self.tile)
+
+    def set_roi(self, roi):
+        if roi != self.roi:
+            self.roi = roi
+            self.allocate()
+            self.valid = False
+
+    def reduce(self, depth_image):
+        return Calibration.crop(depth_image, self.roi, self.compression)
+
+    def reset(self, depth_image):
+        Dtypes.check('depth_image', depth_image, Dtypes.depth)
+        np.copyto(self.mean, self.reduce(depth_image))
+        self.var.fill(0)
+        self.framecount = 0
+        self.updates = 0
+        self.compute_threshold(self.raw)
+        self.image[:] = cv2.erode(self.raw, self.kernel, iterations=self.iter)
+        self.valid = True
+        self.dirty = None
+        return self.image
+
+    def compute_threshold(self, out):
+        # mean minus the larger of clipping_tolerance and bg_sigmas standard deviations, saturated at 0
+        np.sqrt(self.var, out=self.threshold)
+        np.multiply(self.threshold, self.sigmas, out=self.threshold)
+        np.maximum(self.threshold, self.clipping_tolerance, out=self.threshold)
+        np.subtract(self.mean, self.threshold, out=self.threshold)
+        np.clip(self.threshold, 0, 65535, out=self.threshold)
+        np.rint(self.threshold, out=out, casting='unsafe')
+
+    def update(self, depth_image):
+        # returns True if the background image changed
+        if not self.valid:
+            self.reset(depth_image)
+            return True
+        self.framecount += 1
+        if self.framecount % self.update_interval != 0:
+            return False
+
+        depth = self.reduce(Dtypes.check('depth_image', depth_image, Dtypes.depth))
+        np.copyto(self.depth, depth)
+
+        # learn only from valid pixels that are not in front of the background
+        np.greater_equal(depth, self.image, out=self.learn)
+        np.logical_and(self.learn, depth > 0, out=self.learn)
+
+        # exponential mean and variance, in place. a plain running mean until 1 / n drops to bg_alpha,
+        # so the model settles within a few updates instead of drifting away from the first frame
+        self.updates += 1
+        alpha = max(self.alpha, 1.0 / (self.updates + 1))
+        np.subtract(self.depth, self.mean, out=self.diff)
+        np.multiply(self.diff, alpha, out=self.depth)
+        np.add(self.mean, self.depth, out=self.mean, where=self.learn)
+        np.multiply(self.diff, self.depth, out=self.diff)
+        np.add(self.var, self.diff, out=self.diff)
+        np.multiply(self.diff, 1 - alpha, out=self.diff)
+        np.copyto(self.var, self.diff, where=self.learn)
+
+        # once settled, a threshold is only taken over when it is bg_deadband away from the one in
+        # use, sensor noise alone would touch most tiles on every update and force a full erosion
+        self.compute_threshold(self.next_raw)
+        np.subtract(self.threshold, self.raw, out=self.step)
+        np.abs(self.step, out=self.step)
+        np.greater_equal(self.step, self.deadband if alpha == self.alpha else 0.5, out=self.changed)
+        if not self.changed.any():
+            return False
+        np.copyto(self.raw, self.next_raw, where=self.changed)
+        self.erode_changed()
+        return True
+
+    def erode_changed(self):
+        # re-erode only the tiles within the erosion radius of a changed threshold
+        tiles = np.logical_or.reduceat(np.logical_or.reduceat(self.changed, self.tile_rows, axis=0),
+                                       self.tile_cols, axis=1)
+        reach = 2 * -(-self.radius // self.tile) + 1
+        tiles = cv2.dilate(tiles.astype(np.uint8), np.ones((reach, reach), np.uint8)) > 0
+        if np.count_nonzero(tiles) * 2 > tiles.size:
+            cv2.erode(self.raw, self.kernel, dst=self.image, iterations=self.iter)
+            self.dirty = None
+            return
+
+        r = self.radius
+        self.dirty = []
+        for ty, tx in zip(*np.nonzero(tiles)):
+            y0, x0 = ty * self.tile, tx * self.tile
+            y1, x1 = min(y0 + self.tile, self.raw.shape[0]), min(x0 + self.tile, self.raw.shape[1])
+            py0, px0 = max(y0 - r, 0), max(x0 - r, 0)
+            py1, px1 = min(y1 + r, self.raw.shape[0]), min(x1 + r, self.raw.shape[1])
+            eroded = cv2.erode(self.raw[py0:py1, px0:px1], self.kernel, iterations=self.iter)
+            self.image[y0:y1, x0:x1] = eroded[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+            self.dirty.append((y0, y1, x0, x1))
@@ -0,0 +1,364 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+import Background
+import Calibration
+import ChangeDetector
+import CameraBase
+import Config
+import Display
+import Processors
+import Tick
+import TouchDetector
+
+# headless benchmarks of the per frame hot paths on synthetic or recorded frames.
+# no camera and no window are needed, the RealSense backend is replaced by SyntheticCamera
+# and the cv2 window functions by no-ops.
+#
+#   python Benchmark.py                                  run and print
+#   python Benchmark.py --save bench.json                store as baseline
+#   python Benchmark.py --baseline bench.json            fail (exit 1) on regressions
+#   python Benchmark.py --replay ./recordings/session/   recorded instead of synthetic frames
+#   python Benchmark.py --verify --reductions 1 2        check process_images against the reference
+
+resolutions = ((480, 640), (720, 1280))
+reductions = (1, 2, 4)
+
+
+def headless():
+    # keep Display working without a window
+    cv2.imshow = lambda *args: None
+    cv2.waitKey = lambda *args: -1
+    cv2.namedWindow = lambda *args: None
+    cv2.setWindowProperty = lambda *args: None
+    cv2.destroyAllWindows = lambda *args: None
+
+
+def synthetic_frames(h, w, n, seed=0):
+    # tilted table at about 1 m with sensor noise and holes, a finger moving across it
+    # and a bright calibration dot in the colour image
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:h, 0:w]
+    plane = 1000 + 0.05 * xx + 0.03 * yy
+    depth = np.empty((n, h, w), np.uint16)
+    color = np.empty((n, h, w, 3), np.uint8)
+    for i in range(0, n):
+        d = plane + rng.normal(0, 2, (h, w))
+        fx, fy = w * (0.2 + 0.6 * i / n), h * 0.5
+        finger = (xx - fx) ** 2 + (yy - fy) ** 2 < (h / 40) ** 2
+        d[finger] -= 20
+        d[rng.random((h, w)) < 0.01] = 0
+        depth[i] = d
+        color[i] = rng.integers(0, 120, (h, w, 3), np.uint8)
+        color[i][(xx - w // 2) ** 2 + (yy - h // 3) ** 2 < (h / 30) ** 2] = 255
+    return depth, color
+
+
+def recorded_frames(path, n):
+    depth, color = [], []
+    for f in sorted(glob.glob(os.path.join(path, 'chunk_*.npz'))):
+        with np.load(f) as data:
+            depth.append(data['depth'])
+            color.append(data['color'])
+        if sum(len(d) for d in depth) >= n:
+            break
+    if len(depth) == 0:
+        return None, None
+    return np.concatenate(depth)[0:n], np.concatenate(color)[0:n]
+
+
+class SyntheticCamera(CameraBase.CameraBase):
+    # plays frames from memory in a loop, stands in for the RealSense backend
+
+    def __init__(self, conf, tick, depth, color):
+        super().__init__(conf, tick)
+        self.depth = depth
+        self.color = color
+        self.index = 0
+
+    def open(self):
+        return True
+
+    def close(self):
+        pass
+
+    def grab(self):
+        i = self.index % len(self.depth)
+        self.index += 1
+        return self.depth[i], self.color[i], self.index, self.index * 1000.0 / 30
+
+
+def make_conf(h, w, c, tmp):
+    conf = Config.Config()
+    conf.img_h, conf.img_w = h, w
+    conf.sampling_reduction = c
+    conf.async_acquisition = False
+    conf.use_numba = True
+    conf.tick_export = ''
+    conf.tick_port = 0
+    conf.calib_file = os.path.join(tmp, 'calib.lut')
+    conf.calib_file_x = os.path.join(tmp, 'calib_x.csv')
+    conf.calib_file_y = os.path.join(tmp, 'calib_y.csv')
+    return conf
+
+
+def calib_points(conf):
+    # dot grid seen through a slightly rotated and shifted camera
+    pts = []
+    for vid_x, vid_y in Calibration.grid_points(conf):
+        s = 0.6 * conf.img_w / conf.vid_w
+        pts.append((vid_x, vid_y, 0.15 * conf.img_w + s * vid_x + 0.02 * vid_y, 0.2 * conf.img_h + s * vid_y))
+    return pts
+
+
+def measure(func, repeat, warmup):
+    # latency percentiles [ms], throughput [1/s] and peak traced memory [MB] of func()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(0, warmup):
+            func()
+        times = np.empty(repeat)
+        for i in range(0, repeat):
+            start = time.perf_counter()
+            func()
+            times[i] = time.perf_counter() - start
+        # separate pass, tracing slows the calls down
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    p50, p95, p99 = np.percentile(times, (50, 95, 99)) * 1000
+    return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4),
+            'max': round(float(times.max() * 1000), 4), 'fps': round(float(repeat / times.sum()), 2),
+            'peak_mb': round(peak / 2 ** 20, 4)}
+
+
+def cases(conf, depth, color, tmp):
+    # name -> callable, every call is one unit of work on the next frame
+    tick = Tick.Tick(conf)
+    cam = SyntheticCamera(conf, tick, depth, color)
+    cam.start()
+    roi = Calibration.full_roi(conf.img_h, conf.img_w)
+    proc = Processors.Processors(conf)
+    proc.set_roi(roi)
+    bgm = Background.Background(conf)
+    tiled = Processors.Processors(conf)
+    changes = ChangeDetector.ChangeDetector(conf)
+    touch = TouchDetector.TouchDetector(conf)
+    disp = Display.Display(conf)
+    disp.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bg = proc.generate_background_from_image(depth[0])
+    bgm.reset(depth[0])
+    grey_bg = proc.grey(color[0])
+    points = calib_points(conf)
+    state = {'i': 0}
+
+    def frame():
+        state['i'] = (state['i'] + 1) % len(depth)
+        return depth[state['i']], color[state['i']]
+
+    def process():
+        proc.process_images(*frame(), bg)
+
+    def process_tiled():
+        # change detection, then separation and colormap of the changed tiles only
+        depth_image, color_image = frame()
+        tiles = changes.update(depth_image, changes.active(tiled.result_depth))
+        tiles = None if tiles is None else changes.rects(tiles)
+        tiled.process_images(depth_image, color_image, bg, tiles)
+        disp.color_depth_reduced(depth_image, tiles)
+
+    def process_reference():
+        proc.process_images_reference(*frame(), bg)
+
+    def generate_background():
+        proc.generate_background_from_image(frame()[0])
+
+    def background_update():
+        # every call is an update frame
+        bgm.framecount = bgm.update_interval - 1
+        bgm.update(frame()[0])
+
+    def touch_detect():
+        result_img, result_depth_3d = proc.process_images(*frame(), bg)
+        touch.detect(result_depth_3d[:, :, 0], bg)
+
+    def blob_detection():
+        proc.blob_detection(cam, conf, grey_bg)
+
+    def blob_burst():
+        proc.blob_burst(cam, conf, grey_bg)
+
+    def lookup_table():
+        cam.calib_points = []
+        for vid_x, vid_y, x, y in points:
+            cam.set_lookup_point(vid_x, vid_y, x, y)
+        cam.do_lookup_table()
+
+    def calib_csv_io():
+        Calibration.export_csv(cam.lookup_table, conf.calib_file_x, conf.calib_file_y)
+        Calibration.import_csv(conf.calib_file_x, conf.calib_file_y)
+
+    def calib_table_io():
+        Calibration.write_table(conf.calib_file, conf, {'lookup': cam.lookup_table, 'inverse': cam.inverse_table})
+        tables = Calibration.read_table(conf.calib_file, conf)
+        np.asarray(tables['lookup']).sum()
+
+    def display_compose():
+        depth_image, color_image = frame()
+        result_img, result_depth_3d = proc.process_images(depth_image, color_image, bg)
+        disp.update_streams(disp.color_depth_reduced(depth_image), result_img)
+        disp.update_info(['frame ' + str(state['i'])])
+        disp.show()
+
+    lookup_table()
+    return {'process': process, 'process_tiled': process_tiled, 'process_reference': process_reference,
+            'generate_background': generate_background, 'background_update': background_update,
+            'touch_detect': touch_detect, 'blob_detection': blob_detection, 'blob_burst': blob_burst,
+            'lookup_table': lookup_table, 'calib_csv_io': calib_csv_io, 'calib_table_io': calib_table_io,
+            'display_compose': display_compose}
+
+
+def run(args):
+    headless()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.replay:
+            depth, color = recorded_frames(args.replay, args.frames)
+            if depth is None:
+                print('Error: No recording found in ' + args.replay)
+                return None
+            sizes = (depth.shape[1:3],)
+        else:
+            sizes = [tuple(int(v) for v in s.split('x')) for s in args.resolutions]
+        for h, w in sizes:
+            if not args.replay:
+                depth, color = synthetic_frames(h, w, args.frames)
+            for c in args.reductions:
+                conf = make_conf(h, w, c, tmp)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    paths = cases(conf, depth, color, tmp)
+                for name, func in paths.items():
+                    if args.only and name not in args.only:
+                        continue
+                    # one shot paths get fewer repetitions
+                    repeat = args.repeat if name not in ('lookup_table', 'calib_csv_io') else max(3, args.repeat // 10)
+                    key = name + '/' + str(h) + 'x' + str(w) + '/c' + str(c)
+                    results[key] = measure(func, repeat, args.warmup)
+                    r = results[key]
+                    print(key.ljust(40) + ' p50 ' + format(r['p50'], '8.2f') + '  p95 ' + format(r['p95'], '8.2f') +
+                          '  p99 ' + format(r['p99'], '8.2f') + ' ms  ' + format(r['fps'], '9.1f') + ' /s  ' +
+                          format(r['peak_mb'], '7.2f') + ' MB')
+    return results
+
+
+def verify(args):
+    # mismatches of process_images, numba and numpy, against process_images_reference on every frame
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.replay:
+            depth, color = recorded_frames(args.replay, args.frames)
+            if depth is None:
+                print('Error: No recording found in ' + args.replay)
+                return None
+            sizes = (depth.shape[1:3],)
+        else:
+            sizes = [tuple(int(v) for v in s.split('x')) for s in args.resolutions]
+        for h, w in sizes:
+            if not args.replay:
+                depth, color = synthetic_frames(h, w, args.frames)
+            for c in args.reductions:
+                for use_numba in (True, False):
+                    conf = make_conf(h, w, c, tmp)
+                    conf.use_numba = use_numba
+                    proc = Processors.Processors(conf)
+                    proc.set_roi(Calibration.full_roi(h, w))
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        bg = proc.generate_background_from_image(depth[0])
+                    path = 'numba' if use_numba else 'numpy'
+                    key = 'process_images/' + path + '/' + str(h) + 'x' + str(w) + '/c' + str(c)
+                    if use_numba and Processors.separate_kernel() is None:
+                        print(key.ljust(40) + ' skipped, no numba')
+                        continue
+                    bad = []
+                    for i in range(0, len(depth)):
+                        result_img, result_depth_3d = proc.process_images(depth[i], color[i], bg)
+                        ref_img, ref_depth_3d = proc.process_images_reference(depth[i], color[i], bg)
+                        if not (np.array_equal(result_img, ref_img) and np.array_equal(result_depth_3d, ref_depth_3d)):
+                            bad.append(i)
+                    print(key.ljust(40) + (' ok' if not bad else ' MISMATCH on ' + str(len(bad)) + ' frames'))
+                    if bad:
+                        failures.append(key + ' frames ' + str(bad))
+    return failures
+
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    # regressions against the baseline: latency above (1 + tolerance), memory above (1 + memory_tolerance)
+    failures = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None:
+            continue
+        for metric in ('p50', 'p95'):
+            if r[metric] > b[metric] * (1 + tolerance):
+                failures.append(key + ' ' + metric + ' ' + str(r[metric]) + ' ms, baseline ' + str(b[metric]) + ' ms')
+        if r['peak_mb'] > b['peak_mb'] * (1 + memory_tolerance) + 0.01:
+            failures.append(key + ' peak ' + str(r['peak_mb']) + ' MB, baseline ' + str(b['peak_mb']) + ' MB')
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='beamer hot path benchmarks')
+    parser.add_argument('--resolutions', nargs='+', default=[str(h) + 'x' + str(w) for h, w in resolutions])
+    parser.add_argument('--reductions', nargs='+', type=int, default=list(reductions))
+    parser.add_argument('--only', nargs='+', default=None, help='run these paths only')
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--replay', default='', help='recording folder instead of synthetic frames')
+    parser.add_argument('--save', default='', help='write results as baseline json')
+    parser.add_argument('--baseline', default='', help='compare against this baseline json')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--memory-tolerance', type=float, default=0.10)
+    parser.add_argument('--verify', action='store_true', help='check results against the reference, no timing')
+    args = parser.parse_args(argv)
+
+    if args.verify:
+        headless()
+        failures = verify(args)
+        if failures is None:
+            return 2
+        for failure in failures:
+            print('MISMATCH ' + failure)
+        return 1 if failures else 0
+
+    results = run(args)
+    if results is None:
+        return 2
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'time': time.time(), 'numba': Processors.separate_kernel() is not None, 'results': results},
+                      f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        failures = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import json
+import os
+import zlib
+import numpy as np
+import cv2
+
+import Dtypes
+
+# binary calibration file: magic, json header padded to header_size, then the float32 arrays
+# listed in the header. version 2 stores the lookup table [vid_h, vid_w, 2] and the inverse index
+# [img_h / sampling_reduction, img_w / sampling_reduction, 2], version 1 only the lookup table.
+table_magic = b'GESINA-LUT'
+table_version = 2
+table_dtype = np.float32
+header_size = 512
+
+
+def grid_points(conf):
+    # projector positions of the calibration dots, row by row
+    nx, ny = conf.calib_grid
+    x0, y0, x1, y1 = conf.calib_area
+    xs = np.linspace(x0, x1, nx).astype(int)
+    ys = np.linspace(y0, y1, ny).astype(int)
+    return [(int(x), int(y)) for x in xs for y in ys]
+
+
+def write_table(filename, conf, tables):
+    # tables: name -> array, written in the given order
+    data = [(name, np.ascontiguousarray(table, dtype=table_dtype)) for name, table in tables.items()]
+    header = {'version': table_version,
+              'vid_h': conf.vid_h,
+              'vid_w': conf.vid_w,
+              'img_h': conf.img_h,
+              'img_w': conf.img_w,
+              'sampling_reduction': conf.sampling_reduction,
+              'dtype': np.dtype(table_dtype).str,
+              'arrays': [[name, list(table.shape), zlib.crc32(table.tobytes())] for name, table in data]}
+    header = table_magic + json.dumps(header).encode('ascii')
+    if len(header) > header_size:
+        raise ValueError('Calibration header exceeds ' + str(header_size) + ' bytes')
+    # written next to the file and renamed over it, a crash never leaves a half written table and
+    # a reader that has the old file mapped keeps its pages instead of getting SIGBUS on truncation
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(header_size, b' '))
+        for name, table in data:
+            f.write(table.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        raw = f.read(header_size)
+    if not raw.startswith(table_magic):
+        return None
+    # the header is padded with spaces, anything after the json object belongs to the data
+    header = json.JSONDecoder().raw_decode(raw[len(table_magic):].decode('latin-1'))[0]
+    if header['version'] == 1:
+        # 256 byte header, lookup table only
+        header['arrays'] = [['lookup', [header['vid_h'], header['vid_w'], 2], header['crc32']]]
+        header['offset'] = 256
+    else:
+        header['offset'] = header_size
+    return header
+
+
+def read_table(filename, conf, verify=True):
+    # memory mapped and read only, nothing is parsed beyond the header. returns name -> array
+    header = read_header(filename)
+    if header is None or header['version'] > table_version:
+        print('Error: ' + filename + ' is not a calibration table up to version ' + str(table_version))
+        return None
+    if (header['vid_h'], header['vid_w']) != (conf.vid_h, conf.vid_w):
+        print('Error: calibration table ' + filename + ' was made for ' +
+              str(header['vid_w']) + 'x' + str(header['vid_h']))
+        return None
+
+    tables = {}
+    offset = header['offset']
+    for name, shape, crc in header['arrays']:
+        table = np.memmap(filename, dtype=header['dtype'], mode='r', offset=offset, shape=tuple(shape))
+        if verify and zlib.crc32(table) != crc:
+            print('Error: checksum mismatch in calibration table ' + filename)
+            return None
+        tables[name] = table
+        offset += table.nbytes
+
+    # the inverse index only fits the sampling reduction it was built for
+    if header['sampling_reduction'] != conf.sampling_reduction or header['img_h'] != conf.img_h or \
+            header['img_w'] != conf.img_w:
+        tables.pop('inverse', None)
+    return tables
+
+
+def build_inverse(table, img_h, img_w, compression):
+    # camera cell [img_y / compression, img_x / compression] -> mean (vid_y, vid_x) of the
+    # projector pixels landing in it, NaN where the projector does not reach
+    inv_h = len(range(0, img_h, compression))
+    inv_w = len(range(0, img_w, compression))
+    vid_h, vid_w = table.shape[0:2]
+    cam = table.reshape(-1, 2)
+    vid_y, vid_x = np.divmod(np.arange(vid_h * vid_w), vid_w)
+
+    # lookup entries clipped to the image border lie outside the camera view
+    valid = (cam[:, 0] > 0) & (cam[:, 0] < img_h - 1) & (cam[:, 1] > 0) & (cam[:, 1] < img_w - 1)
+    iy = np.clip(np.rint(cam[valid, 0] / compression).astype(np.int64), 0, inv_h - 1)
+    ix = np.clip(np.rint(cam[valid, 1] / compression).astype(np.int64), 0, inv_w - 1)
+    cell = iy * inv_w + ix
+
+    count = np.bincount(cell, minlength=inv_h * inv_w).astype(np.float32).reshape(inv_h, inv_w)
+    sum_y = np.bincount(cell, vid_y[valid], minlength=inv_h * inv_w).astype(np.float32).reshape(inv_h, inv_w)
+    sum_x = np.bincount(cell, vid_x[valid], minlength=inv_h * inv_w).astype(np.float32).reshape(inv_h, inv_w)
+
+    # close single cell gaps where the projector is sparser than the camera grid
+    for i in range(0, 2):
+        empty = count == 0
+        blur_count = cv2.blur(count, (3, 3))
+        fill = empty & (blur_count > 0)
+        if not fill.any():
+            break
+        sum_y[fill] = (cv2.blur(sum_y, (3, 3))[fill] / blur_count[fill])
+        sum_x[fill] = (cv2.blur(sum_x, (3, 3))[fill] / blur_count[fill])
+        count[fill] = 1
+
+    inverse = np.full((inv_h, inv_w, 2), np.nan, np.float32)
+    known = count > 0
+    inverse[known, 0] = sum_y[known] / count[known]
+    inverse[known, 1] = sum_x[known] / count[known]
+    return inverse
+
+
+def query_inverse(inverse, points, compression):
+    # points: (n, 2) camera (x, y) -> (n, 2) projector (x, y), bilinear over the known neighbours
+    points = Dtypes.coords(points)
+    fx = np.clip(points[:, 0] / compression, 0, inverse.shape[1] - 1)
+    fy = np.clip(points[:, 1] / compression, 0, inverse.shape[0] - 1)
+    x0 = np.minimum(fx.astype(np.int64), inverse.shape[1] - 2)
+    y0 = np.minimum(fy.astype(np.int64), inverse.shape[0] - 2)
+    tx = (fx - x0)[:, np.newaxis]
+    ty = (fy - y0)[:, np.newaxis]
+
+    corners = np.stack((inverse[y0, x0], inverse[y0, x0 + 1], inverse[y0 + 1, x0], inverse[y0 + 1, x0 + 1]), axis=1)
+    weights = np.hstack(((1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx))
+    weights = np.where(np.isnan(corners[:, :, 0]), 0, weights)
+    total = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vid = np.nansum(corners * weights[:, :, np.newaxis], axis=1) / total[:, np.newaxis]
+    vid[total == 0] = np.nan
+    return vid[:, ::-1]
+
+
+def full_roi(img_h, img_w):
+    # camera region of interest (x0, y0, x1, y1) in full resolution pixels
+    return 0, 0, img_w, img_h
+
+
+def footprint(table, img_h, img_w, compression, margin):
+    # bounding box of the projector footprint in the camera image, origin on the sampling grid
+    x0 = int(np.floor(np.min(table[:, :, 1]))) - margin
+    y0 = int(np.floor(np.min(table[:, :, 0]))) - margin
+    x1 = int(np.ceil(np.max(table[:, :, 1]))) + margin + 1
+    y1 = int(np.ceil(np.max(table[:, :, 0]))) + margin + 1
+    x0 = max(x0, 0) // compression * compression
+    y0 = max(y0, 0) // compression * compression
+    return x0, y0, min(x1, img_w), min(y1, img_h)
+
+
+def crop(image, roi, compression):
+    x0, y0, x1, y1 = roi
+    return image[y0:y1:compression, x0:x1:compression]
+
+
+def crop_shape(roi, compression):
+    x0, y0, x1, y1 = roi
+    return len(range(y0, y1, compression)), len(range(x0, x1, compression))
+
+
+def export_csv(table, file_x, file_y):
+    np.savetxt(file_x, table[:, :, 1], delimiter=';')
+    np.savetxt(file_y, table[:, :, 0], delimiter=';')
+
+
+def import_csv(file_x, file_y):
+    x = np.genfromtxt(file_x, delimiter=';')
+    y = np.genfromtxt(file_y, delimiter=';')
+    return np.dstack((y, x)).astype(Dtypes.coord)
+
+
+class Calibration:
+
+    def __init__(self, conf):
+        self.vid_h = conf.vid_h
+        self.vid_w = conf.vid_w
+        self.img_h = conf.img_h
+        self.img_w = conf.img_w
+        self.method = conf.calib_method
+        self.homography = None
+        self.residual = None
+        self.rms = 0.0
+
+    def fit(self, vid_pts, img_pts):
+        # vid_pts: (n, 2) projector (x, y), img_pts: (n, 2) camera (x, y)
+        vid_pts = np.asarray(vid_pts, dtype=np.float64)
+        img_pts = np.asarray(img_pts, dtype=np.float64)
+        if vid_pts.shape[0] < 4:
+            raise ValueError('Calibration needs at least 4 correspondences')
+
+        self.homography = self.fit_homography(vid_pts, img_pts)
+        grid = self.as_grid(vid_pts, img_pts)
+        if self.method == 'bilinear' and grid is not None:
+            table = self.dense_bilinear(*grid)
+        else:
+            table = self.dense_homography(self.homography)
+
+        # reprojection residual of every dot against the least squares homography, in camera pixels.
+        # the bilinear table passes through every dot, so its own residual would always be 0; this
+        # is the dot noise plus the non-planarity the bilinear table absorbs
+        projected = np.hstack((vid_pts, np.ones((vid_pts.shape[0], 1)))) @ self.homography.T
+        predicted = projected[:, 0:2] / projected[:, 2:3]
+        self.residual = np.linalg.norm(predicted - img_pts, axis=1)
+        self.rms = float(np.sqrt(np.mean(self.residual ** 2)))
+        return table
+
+    @staticmethod
+    def fit_homography(vid_pts, img_pts):
+        # normalized DLT, least squares over all correspondences
+        def normalize(pts):
+            mean = pts.mean(axis=0)
+            scale = np.sqrt(2) / max(np.mean(np.linalg.norm(pts - mean, axis=1)), 1e-12)
+            return np.array([[scale, 0, -scale * mean[0]],
+                             [0, scale, -scale * mean[1]],
+                             [0, 0, 1]])
+
+        t_vid = normalize(vid_pts)
+        t_img = normalize(img_pts)
+        src = vid_pts @ t_vid[:2, :2].T + t_vid[:2, 2]
+        dst = img_pts @ t_img[:2, :2].T + t_img[:2, 2]
+
+        n = src.shape[0]
+        a = np.zeros((2 * n, 9))
+        a[0::2, 0:2] = src
+        a[0::2, 2] = 1
+        a[0::2, 6:8] = -dst[:, 0:1] * src
+        a[0::2, 8] = -dst[:, 0]
+        a[1::2, 3:5] = src
+        a[1::2, 5] = 1
+        a[1::2, 6:8] = -dst[:, 1:2] * src
+        a[1::2, 8] = -dst[:, 1]
+
+        h = np.linalg.svd(a)[2][-1].reshape(3, 3)
+        h = np.linalg.inv(t_img) @ h @ t_vid
+        return h / h[2, 2]
+
+    @staticmethod
+    def as_grid(vid_pts, img_pts):
+        # arrange the correspondences as a full rectangular grid, None if they are not one
+        xs = np.unique(vid_pts[:, 0])
+        ys = np.unique(vid_pts[:, 1])
+        if xs.size < 2 or ys.size < 2 or xs.size * ys.size != vid_pts.shape[0]:
+            return None
+        ix = np.searchsorted(xs, vid_pts[:, 0])
+        iy = np.searchsorted(ys, vid_pts[:, 1])
+        nodes = np.full((ys.size, xs.size, 2), np.nan)
+        nodes[iy, ix] = img_pts
+        if np.isnan(nodes).any():
+            return None
+        return xs, ys, nodes
+
+    def dense_bilinear(self, xs, ys, nodes):
+        # piecewise bilinear between neighbouring dots, edge cells extrapolate linearly
+        ix, tx = self.cell_weights(xs, self.vid_w)
+        iy, ty = self.cell_weights(ys, self.vid_h)
+        tx = tx[np.newaxis, :, np.newaxis]
+        ty = ty[:, np.newaxis, np.newaxis]
+
+        # separable: interpolate every dot row along x, then the rows along y
+        rows = nodes[:, ix] * (1 - tx) + nodes[:, ix + 1] * tx
+        camera = rows[iy] * (1 - ty) + rows[iy + 1] * ty
+        return self.to_table(camera[:, :, 0], camera[:, :, 1])
+
+    @staticmethod
+    def cell_weights(keys, size):
+        pos = np.arange(size, dtype=np.float64)
+        idx = np.clip(np.searchsorted(keys, pos, side='right') - 1, 0, keys.size - 2)
+        t = (pos - keys[idx]) / (keys[idx + 1] - keys[idx])
+        return idx, t
+
+    def dense_homography(self, h):
+        x = np.arange(self.vid_w, dtype=np.float64)[np.newaxis, :]
+        y = np.arange(self.vid_h, dtype=np.float64)[:, np.newaxis]
+        w = h[2, 0] * x + h[2, 1] * y + h[2, 2]
+        cam_x = (h[0, 0] * x + h[0, 1] * y + h[0, 2]) / w
+        cam_y = (h[1, 0] * x + h[1, 1] * y + h[1, 2]) / w
+        return self.to_table(cam_x, cam_y)
+
+    def to_table(self, cam_x, cam_y):
+        # lookup_table layout: [vid_y, vid_x] -> (img_y, img_x)
+        table = np.empty((self.vid_h, self.vid_w, 2), Dtypes.coord)
+        np.clip(cam_y, 0, self.img_h - 1, out=table[:, :, 0])
+        np.clip(cam_x, 0, self.img_w - 1, out=table[:, :, 1])
+        return table
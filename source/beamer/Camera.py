@@ -1,33 +1,49 @@
 import pyrealsense2 as rs
 import numpy as np
+import cv2
 
+import CameraBase
 
-def file_exists(filename):
-    try:
-        f = open(filename)
-        f.close()
-        return True
-    except IOError:
-        return False
 
+class Camera(CameraBase.CameraBase):
 
-class Camera:
+    def __init__(self, conf, tick):
+        super().__init__(conf, tick)
 
-    def __init__(self, conf):
-        self.vid_h = conf.vid_h
-        self.vid_w = conf.vid_w
-        self.calib_file_x = conf.calib_file_x
-        self.calib_file_y = conf.calib_file_y
-        self.calib_done = False
-
-        self.reset_lookup_table()
-        self.read_lookup_table()
-
-        # Configure depth and color streams
+        # Configure depth and color streams, color defines the image size everything else works in
+        depth_w, depth_h = conf.rs_depth_size if conf.rs_depth_size else (self.img_w, self.img_h)
         self.pipeline = rs.pipeline()
         self.config = rs.config()
-        self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        self.config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+        if conf.camera_serial:
+            self.config.enable_device(conf.camera_serial)
+        self.config.enable_stream(rs.stream.depth, depth_w, depth_h, rs.format.z16, conf.fps)
+        self.config.enable_stream(rs.stream.color, self.img_w, self.img_h, rs.format.bgr8, conf.fps)
+
+        # 'color': full frame rs.align, 'roi': depth remapped into the roi only, 'none': raw depth
+        self.align_mode = conf.rs_align
+        self.decimation = conf.rs_decimation
+        if self.align_mode == 'none' and (self.decimation > 1 or (depth_w, depth_h) != (self.img_w, self.img_h)):
+            print('Warning: rs_align none needs undecimated depth in image size, decimation disabled')
+            self.decimation = 1
+            self.config.disable_stream(rs.stream.depth)
+            self.config.enable_stream(rs.stream.depth, self.img_w, self.img_h, rs.format.z16, conf.fps)
+
+        # librealsense post processing on the depth frame, before alignment
+        self.filters = []
+        if self.decimation > 1:
+            decimation = rs.decimation_filter()
+            decimation.set_option(rs.option.filter_magnitude, self.decimation)
+            self.filters.append(decimation)
+        if conf.rs_spatial or conf.rs_temporal:
+            # edge preserving filters work best on disparity
+            self.filters.append(rs.disparity_transform(True))
+            if conf.rs_spatial:
+                self.filters.append(rs.spatial_filter())
+            if conf.rs_temporal:
+                self.filters.append(rs.temporal_filter())
+            self.filters.append(rs.disparity_transform(False))
+        if conf.rs_hole_filling:
+            self.filters.append(rs.hole_filling_filter())
 
         # Create an align object
         # rs.align allows us to perform alignment of depth frames to others frames
@@ -35,130 +51,95 @@ class Camera:
         align_to = rs.stream.color
         self.align = rs.align(align_to)
 
-        self.status = False
+        # roi alignment: color pixel -> depth pixel maps for a plane at the scene depth
+        self.depth_scale = 0.001
+        self.map_roi = None
+        self.map_x = None
+        self.map_y = None
+        self.depth_out = np.zeros((self.img_h, self.img_w), np.uint16)
 
-    def start(self):
+    def open(self):
         try:
-            self.pipeline.start(self.config)
-            self.status = True
+            profile = self.pipeline.start(self.config)
+            self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+            self.map_roi = None
+            return True
         except:
-            self.status = False
             print('Error: No Realsense Camera detected!')
+            return False
 
-    def stop(self):
-        if self.status:
-            self.pipeline.stop()
-            self.status = False
+    def close(self):
+        self.pipeline.stop()
 
     def get_frames(self):
         while True:
             # Wait for a coherent pair of frames: depth and color
-            frames = self.pipeline.wait_for_frames()
-
-            # Align the depth frame to color frame
-            aligned_frames = self.align.process(frames)
-
-            depth_frame = aligned_frames.get_depth_frame()
-            color_frame = aligned_frames.get_color_frame()
-
-            if not depth_frame or not color_frame:
-                continue
+            with self.tick.stage('acquire'):
+                frames = self.pipeline.wait_for_frames()
+
+            with self.tick.stage('align'):
+                # filters replace the depth frame of the set and pass the color frame through
+                for f in self.filters:
+                    frames = f.process(frames).as_frameset()
+                # Align the depth frame to color frame
+                if self.align_mode == 'color':
+                    frames = self.align.process(frames)
+
+                depth_frame = frames.get_depth_frame()
+                color_frame = frames.get_color_frame()
+                if not depth_frame or not color_frame:
+                    continue
+
+                depth_image = np.asanyarray(depth_frame.get_data())
+                if self.align_mode == 'roi':
+                    depth_image = self.align_roi(depth_frame, color_frame, depth_image)
 
             break
 
-        return depth_frame, color_frame
+        return depth_frame, color_frame, depth_image
 
     def get_depth_frame(self):
-        depth_frame, color_frame = self.get_frames()
+        depth_frame, color_frame, depth_image = self.get_frames()
         return depth_frame
 
     def get_color_frame(self):
-        depth_frame, color_frame = self.get_frames()
+        depth_frame, color_frame, depth_image = self.get_frames()
         return color_frame
 
-    def get_images(self):
-        depth_frame, color_frame = self.get_frames()
-
-        depth_image = np.asanyarray(depth_frame.get_data())
+    def build_roi_map(self, depth_frame, color_frame, depth_image):
+        # color pixels of the roi deprojected onto a plane at the median scene depth and projected
+        # into the depth image. fingers are a few cm above the plane, the parallax error is well below a pixel
+        depth_profile = depth_frame.profile.as_video_stream_profile()
+        color_profile = color_frame.profile.as_video_stream_profile()
+        di = depth_profile.get_intrinsics()
+        ci = color_profile.get_intrinsics()
+        extrinsics = color_profile.get_extrinsics_to(depth_profile)
+        rotation = np.array(extrinsics.rotation, np.float32).reshape(3, 3).T
+        translation = np.array(extrinsics.translation, np.float32)
+
+        valid = depth_image[depth_image > 0]
+        z = float(np.median(valid)) * self.depth_scale if valid.size > 0 else 1.0
+
+        x0, y0, x1, y1 = self.roi
+        v, u = np.mgrid[y0:y1, x0:x1].astype(np.float32)
+        points = np.stack(((u - ci.ppx) / ci.fx * z, (v - ci.ppy) / ci.fy * z, np.full_like(u, z)), axis=-1)
+        points = points @ rotation.T + translation
+        self.map_x = (points[:, :, 0] / points[:, :, 2] * di.fx + di.ppx).astype(np.float32)
+        self.map_y = (points[:, :, 1] / points[:, :, 2] * di.fy + di.ppy).astype(np.float32)
+        self.depth_out.fill(0)
+        self.map_roi = self.roi
+
+    def align_roi(self, depth_frame, color_frame, depth_image):
+        # depth in color coordinates inside the roi, zero outside. valid until the next grab
+        if self.map_roi != self.roi:
+            self.build_roi_map(depth_frame, color_frame, depth_image)
+        x0, y0, x1, y1 = self.roi
+        cv2.remap(depth_image, self.map_x, self.map_y, cv2.INTER_NEAREST,
+                  dst=self.depth_out[y0:y1, x0:x1], borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return self.depth_out
+
+    def grab(self):
+        depth_frame, color_frame, depth_image = self.get_frames()
         color_image = np.asanyarray(color_frame.get_data())
 
-        return depth_image, color_image
-
-    def get_depth_image(self):
-        depth_image, color_image = self.get_images()
-        return depth_image
-
-    def get_color_image(self):
-        depth_image, color_image = self.get_images()
-        return color_image
-
-    def set_lookup_point(self, x, y, x_img, y_img):
-        self.lookup_table[y, x, :] = (y_img, x_img)
-
-    def do_lookup_table(self):
-        index = np.where(self.lookup_table > 0)
-        x_key = (index[1].min(), int(index[1].sum() / 6 - index[1].min() - index[1].max()), index[1].max())
-        y_key = (index[0].min(), int(index[0].sum() / 6 - index[0].min() - index[0].max()), index[0].max())
-
-        for i in range(0, len(x_key)):
-            for j in range(0, len(y_key)):
-                if i < 2:
-                    dx = (self.lookup_table[y_key[j], x_key[i + 1], 1] - self.lookup_table[y_key[j], x_key[i], 1]) / (
-                            x_key[i + 1] - x_key[i])
-                    dy = (self.lookup_table[y_key[j], x_key[i + 1], 0] - self.lookup_table[y_key[j], x_key[i], 0]) / (
-                            x_key[i + 1] - x_key[i])
-                    for h in range(1, x_key[i + 1] - x_key[i]):
-                        self.lookup_table[y_key[j], x_key[i] + h, 1] = self.lookup_table[y_key[j], x_key[i], 1] + dx * h
-                        self.lookup_table[y_key[j], x_key[i] + h, 0] = self.lookup_table[y_key[j], x_key[i], 0] + dy * h
-                if j < 2:
-                    dx = (self.lookup_table[y_key[j + 1], x_key[i], 1] - self.lookup_table[y_key[j], x_key[i], 1]) / (
-                            y_key[j + 1] - y_key[j])
-                    dy = (self.lookup_table[y_key[j + 1], x_key[i], 0] - self.lookup_table[y_key[j], x_key[i], 0]) / (
-                            y_key[j + 1] - y_key[j])
-                    for h in range(1, y_key[j + 1] - y_key[j]):
-                        self.lookup_table[y_key[j] + h, x_key[i], 1] = self.lookup_table[y_key[j], x_key[i], 1] + dx * h
-                        self.lookup_table[y_key[j] + h, x_key[i], 0] = self.lookup_table[y_key[j], x_key[i], 0] + dy * h
-
-        for i in range(x_key[0] + 1, x_key[2]):
-            if i == x_key[1]:
-                continue
-            for j in range(0, 2):
-                dx = (self.lookup_table[y_key[j + 1], i, 1] - self.lookup_table[y_key[j], i, 1]) / (
-                            y_key[j + 1] - y_key[j])
-                dy = (self.lookup_table[y_key[j + 1], i, 0] - self.lookup_table[y_key[j], i, 0]) / (
-                            y_key[j + 1] - y_key[j])
-                for h in range(1, y_key[j + 1] - y_key[j]):
-                    self.lookup_table[y_key[j] + h, i, 1] = self.lookup_table[y_key[j], i, 1] + dx * h
-                    self.lookup_table[y_key[j] + h, i, 0] = self.lookup_table[y_key[j], i, 0] + dy * h
-
-        for j in range(y_key[0] + 1, y_key[2]):
-            if j == y_key[1]:
-                continue
-            for i in range(0, 2):
-                dx = (self.lookup_table[j, x_key[i + 1], 1] - self.lookup_table[j, x_key[i], 1]) / (
-                            x_key[i + 1] - x_key[i])
-                dy = (self.lookup_table[j, x_key[i + 1], 0] - self.lookup_table[j, x_key[i], 0]) / (
-                            x_key[i + 1] - x_key[i])
-                for h in range(1, x_key[i + 1] - x_key[i]):
-                    self.lookup_table[j, x_key[i] + h, 1] = self.lookup_table[j, x_key[i], 1] + dx * h
-                    self.lookup_table[j, x_key[i] + h, 0] = self.lookup_table[j, x_key[i], 0] + dy * h
-
-        self.calib_done = True
-
-    def query_lookup_table(self, x, y):
-        return self.lookup_table[y, x, :]
-
-    def write_lookup_table(self):
-        if self.calib_done:
-            np.savetxt(self.calib_file_x, self.lookup_table[:, :, 1], delimiter=';')
-            np.savetxt(self.calib_file_y, self.lookup_table[:, :, 0], delimiter=';')
-
-    def read_lookup_table(self):
-        if file_exists(self.calib_file_x):
-            self.lookup_table[:, :, 1] = np.genfromtxt(self.calib_file_x, delimiter=';')
-            if file_exists(self.calib_file_y):
-                self.lookup_table[:, :, 0] = np.genfromtxt(self.calib_file_y, delimiter=';')
-                self.calib_done = True
-
-    def reset_lookup_table(self):
-        self.lookup_table = np.zeros(shape=(self.vid_h, self.vid_w, 2))
+        return depth_image, color_image, depth_frame.get_frame_number(), depth_frame.get_timestamp()
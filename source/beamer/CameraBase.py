@@ -0,0 +1,234 @@
+import threading
+import traceback
+import numpy as np
+
+import Calibration
+import Dtypes
+import FrameBuffer
+
+
+def file_exists(filename):
+    try:
+        f = open(filename)
+        f.close()
+        return True
+    except IOError:
+        return False
+
+
+class CameraBase:
+    # common part of all camera backends: calibration lookup table, asynchronous
+    # acquisition and the image api. backends implement open, close and grab.
+
+    def __init__(self, conf, tick):
+        self.tick = tick
+        self.vid_h = conf.vid_h
+        self.vid_w = conf.vid_w
+        self.vid_offset = np.array(conf.vid_offset, Dtypes.coord)
+        self.img_h = conf.img_h
+        self.img_w = conf.img_w
+        self.conf = conf
+        self.calib_file = conf.calib_file
+        self.calib_file_x = conf.calib_file_x
+        self.calib_file_y = conf.calib_file_y
+        self.calib_export_csv = conf.calib_export_csv
+        self.calib_verify = conf.calib_verify
+        self.calib_done = False
+        self.calibration = Calibration.Calibration(conf)
+        self.use_roi = conf.use_roi
+        self.roi_margin = conf.roi_margin
+        self.roi = Calibration.full_roi(self.img_h, self.img_w)
+
+        self.reset_lookup_table()
+        self.read_lookup_table()
+
+        self.status = False
+
+        # asynchronous acquisition into a ring buffer
+        self.async_acquisition = conf.async_acquisition
+        self.ring_slots = conf.ring_slots
+        self.buffer = None
+        self.thread = None
+        self.running = False
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def grab(self):
+        # returns depth_image, color_image, frame_number, timestamp [ms]
+        raise NotImplementedError
+
+    def start(self):
+        self.status = self.open()
+        if self.status and self.async_acquisition:
+            self.start_async()
+
+    def stop(self):
+        self.stop_async()
+        if self.status:
+            self.close()
+            self.status = False
+
+    def start_async(self):
+        self.buffer = FrameBuffer.FrameBuffer(self.ring_slots, self.img_h, self.img_w)
+        self.running = True
+        self.thread = threading.Thread(target=self.acquire, name='acquisition', daemon=True)
+        self.thread.start()
+
+    def stop_async(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.buffer = None
+
+    def acquire(self):
+        # the buffer is closed however the thread ends, so consumers never wait for frames that do not come
+        try:
+            while self.running:
+                try:
+                    self.buffer.write(*self.grab())
+                except RuntimeError:
+                    # no frame within the backend timeout
+                    continue
+                except EOFError:
+                    break
+        except Exception:
+            print('Error: Camera acquisition stopped')
+            traceback.print_exc()
+        finally:
+            self.buffer.close()
+
+    @property
+    def dropped_frames(self):
+        return self.buffer.dropped if self.buffer is not None else 0
+
+    def get_latest_images(self):
+        # newest frame in the ring, older unread frames are dropped
+        if self.buffer is None:
+            return self.get_images()
+        while True:
+            frame = self.buffer.get_latest()
+            if frame is not None:
+                return frame[0], frame[1]
+            if self.buffer.closed:
+                raise EOFError('Camera stream ended')
+
+    def get_next_images(self):
+        # oldest unread frame in the ring
+        depth_image, color_image, frame_number, timestamp = self.get_next_frame()
+        return depth_image, color_image
+
+    def get_next_frame(self):
+        # like get_next_images, with frame number and timestamp
+        if self.buffer is None:
+            return self.grab()
+        while True:
+            frame = self.buffer.get_next()
+            if frame is not None:
+                return frame
+            if self.buffer.closed:
+                raise EOFError('Camera stream ended')
+
+    def wait_frame(self, latest, timeout):
+        # newest or oldest unread frame, None if none arrives within timeout [s]
+        if self.buffer is None:
+            return self.grab()
+        frame = self.buffer.get_latest(timeout) if latest else self.buffer.get_next(timeout)
+        if frame is None and self.buffer.closed:
+            raise EOFError('Camera stream ended')
+        return frame
+
+    def get_images(self):
+        if self.buffer is not None:
+            return self.get_latest_images()
+
+        depth_image, color_image, frame_number, timestamp = self.grab()
+        return depth_image, color_image
+
+    def get_depth_image(self):
+        depth_image, color_image = self.get_images()
+        return depth_image
+
+    def get_color_image(self):
+        depth_image, color_image = self.get_images()
+        return color_image
+
+    def set_lookup_point(self, x, y, x_img, y_img):
+        self.lookup_table[y, x, :] = (y_img, x_img)
+        self.calib_points.append((x, y, x_img, y_img))
+
+    def do_lookup_table(self):
+        if len(self.calib_points) < 4:
+            print('Error: only ' + str(len(self.calib_points)) + ' calibration points found')
+            self.calib_done = False
+            return
+        points = np.array(self.calib_points, dtype=np.float64)
+        self.lookup_table = self.calibration.fit(points[:, 0:2], points[:, 2:4])
+        self.build_inverse_table()
+        print('Calibration residual to homography (rms): ' + str(round(self.calibration.rms, 2)) + 'px')
+        self.calib_done = True
+        self.update_roi()
+
+    def query_lookup_table(self, x, y):
+        return self.lookup_table[y, x, :]
+
+    def update_roi(self):
+        # camera area the projector covers, every processing stage works on this crop only
+        if self.use_roi and self.calib_done:
+            self.roi = Calibration.footprint(self.lookup_table, self.img_h, self.img_w,
+                                             self.conf.sampling_reduction, self.roi_margin)
+        else:
+            self.roi = Calibration.full_roi(self.img_h, self.img_w)
+
+    def build_inverse_table(self):
+        self.inverse_table = Calibration.build_inverse(self.lookup_table, self.img_h, self.img_w,
+                                                      self.conf.sampling_reduction)
+
+    def camera_to_projector(self, points):
+        # points: (n, 2) camera (x, y) in full resolution -> (n, 2) projector (x, y) in the shared projector
+        # space, NaN outside the projection. the inverse table is relative to the camera's vid_offset
+        vid = Calibration.query_inverse(self.inverse_table, points, self.conf.sampling_reduction)
+        vid += self.vid_offset
+        return vid
+
+    def write_lookup_table(self):
+        if self.calib_done:
+            Calibration.write_table(self.calib_file, self.conf,
+                                    {'lookup': self.lookup_table, 'inverse': self.inverse_table})
+            if self.calib_export_csv:
+                self.export_lookup_table()
+
+    def export_lookup_table(self):
+        Calibration.export_csv(self.lookup_table, self.calib_file_x, self.calib_file_y)
+
+    def read_lookup_table(self):
+        if not file_exists(self.calib_file):
+            self.migrate_lookup_table()
+        if file_exists(self.calib_file):
+            tables = Calibration.read_table(self.calib_file, self.conf, self.calib_verify)
+            if tables is not None:
+                self.lookup_table = tables['lookup']
+                if 'inverse' in tables:
+                    self.inverse_table = tables['inverse']
+                else:
+                    self.build_inverse_table()
+                self.calib_done = True
+                self.update_roi()
+
+    def migrate_lookup_table(self):
+        # one-shot conversion of the old csv pair into the binary table
+        if file_exists(self.calib_file_x) and file_exists(self.calib_file_y):
+            print('Migrating ' + self.calib_file_x + ', ' + self.calib_file_y + ' to ' + self.calib_file)
+            Calibration.write_table(self.calib_file, self.conf,
+                                    {'lookup': Calibration.import_csv(self.calib_file_x, self.calib_file_y)})
+
+    def reset_lookup_table(self):
+        self.lookup_table = np.zeros((self.vid_h, self.vid_w, 2), Dtypes.coord)
+        self.inverse_table = np.full((len(range(0, self.img_h, self.conf.sampling_reduction)),
+                                      len(range(0, self.img_w, self.conf.sampling_reduction)), 2), np.nan, Dtypes.coord)
+        self.calib_points = []
+        self.roi = Calibration.full_roi(self.img_h, self.img_w)
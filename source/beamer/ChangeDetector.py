@@ -0,0 +1,108 @@
+import numpy as np
+import cv2
+
+import Calibration
+import Dtypes
+
+
+class ChangeDetector:
+    # per tile comparison of the reduced depth frame with the last frame processed for that tile.
+    # a tile changed if more than change_min_pixels valid pixels moved by more than the noise
+    # threshold, max(change_threshold, change_relative * depth). the reference of a tile is only
+    # taken over when it changed, so slow drift adds up until it is picked up and the cached
+    # results of a quiet tile never lag its reference by more than the threshold.
+    # tiles next to separated foreground are always active, so slivers below change_min_pixels
+    # at a moving edge are not left behind in the cached results.
+
+    def __init__(self, conf):
+        self.h, self.w = conf.img_h, conf.img_w
+        self.compression = conf.sampling_reduction
+        self.tile = conf.change_tile
+        self.threshold = conf.change_threshold
+        self.relative = conf.change_relative
+        self.min_pixels = conf.change_min_pixels
+        self.full_ratio = conf.change_full_ratio
+
+        self.roi = Calibration.full_roi(self.h, self.w)
+        self.allocate()
+
+    def allocate(self):
+        shape = Calibration.crop_shape(self.roi, self.compression)
+        self.shape = shape
+        self.ref = np.zeros(shape, np.uint16)
+        # per pixel threshold of ref, 65535 where ref is invalid
+        self.limit = np.zeros(shape, np.uint16)
+        self.valid = False
+
+        # scratch buffers, the reduced frame is a strided view and copied once
+        self.depth = np.zeros(shape, np.uint16)
+        self.diff = np.zeros(shape, np.uint16)
+        self.moved = np.zeros(shape, np.uint8)
+        self.known = np.zeros(shape, np.uint8)
+        self.tile_rows = np.append(np.arange(0, shape[0], self.tile), shape[0])
+        self.tile_cols = np.append(np.arange(0, shape[1], self.tile), shape[1])
+        self.dilate_kernel = np.ones((3, 3), np.uint8)
+
+    def set_roi(self, roi):
+        if roi != self.roi:
+            self.roi = roi
+            self.allocate()
+
+    def reduce(self, depth_image):
+        return Calibration.crop(depth_image, self.roi, self.compression)
+
+    def reset(self):
+        # the next update reports a full frame
+        self.valid = False
+
+    def tiles_of(self, mask):
+        # per tile count of the set pixels of a 0/255 mask, from its integral image
+        s = cv2.integral(mask)
+        r, c = self.tile_rows, self.tile_cols
+        return (s[r[1:]][:, c[1:]] - s[r[:-1]][:, c[1:]] - s[r[1:]][:, c[:-1]] + s[r[:-1]][:, c[:-1]]) // 255
+
+    def take(self, region):
+        # the current frame becomes the reference of region
+        ref, limit = self.ref[region], self.limit[region]
+        np.copyto(ref, self.depth[region])
+        np.multiply(ref, self.relative, out=limit, casting='unsafe')
+        np.maximum(limit, self.threshold, out=limit)
+        limit[ref == 0] = 65535
+
+    def active(self, result_depth):
+        # tiles holding or bordering a separated pixel of the last result, None without a result
+        if result_depth is None or result_depth.shape != self.shape:
+            return None
+        cv2.compare(result_depth, 0, cv2.CMP_NE, dst=self.known)
+        tiles = (self.tiles_of(self.known) > 0).astype(np.uint8)
+        return cv2.dilate(tiles, self.dilate_kernel) > 0
+
+    def update(self, depth_image, active=None):
+        # bool tile mask of the changed and active tiles, None if the whole frame has to be processed
+        np.copyto(self.depth, self.reduce(Dtypes.check('depth_image', depth_image, Dtypes.depth)))
+        if not self.valid:
+            self.take((slice(None), slice(None)))
+            self.valid = True
+            return None
+
+        # only pixels valid in both frames count, the sensor drops out along edges every few frames
+        cv2.absdiff(self.depth, self.ref, dst=self.diff)
+        cv2.compare(self.diff, self.limit, cv2.CMP_GT, dst=self.moved)
+        cv2.compare(self.depth, 0, cv2.CMP_NE, dst=self.known)
+        cv2.bitwise_and(self.moved, self.known, dst=self.moved)
+
+        tiles = self.tiles_of(self.moved) > self.min_pixels
+        if active is not None:
+            np.logical_or(tiles, active, out=tiles)
+        if np.count_nonzero(tiles) > self.full_ratio * tiles.size:
+            self.take((slice(None), slice(None)))
+            return None
+        for y0, y1, x0, x1 in self.rects(tiles):
+            self.take((slice(y0, y1), slice(x0, x1)))
+        return tiles
+
+    def rects(self, tiles):
+        # (y0, y1, x0, x1) in reduced pixels, one bounding box per connected group of set tiles
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(tiles.astype(np.uint8), connectivity=8)
+        r, c = self.tile_rows, self.tile_cols
+        return [(int(r[y]), int(r[y + h]), int(c[x]), int(c[x + w])) for x, y, w, h in stats[1:, 0:4]]
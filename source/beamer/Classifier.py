@@ -0,0 +1,160 @@
+import time
+import numpy as np
+
+import Calibration
+import CameraBase
+
+# model file written by export, numpy npz:
+#   w0, b0, w1, b1, ...  dense layers [inputs, outputs], relu in between. one layer is a logistic regression
+#   mean, std            feature normalisation, float32 [train_frames * (2 * train_region) ** 2]
+#   classes              class names of the output units, a single unit is a sigmoid for classes[0]
+# features are the patches of Dataset samples, oldest frame first, flattened to float32.
+
+
+def features(patches):
+    # [n, frames, size, size] background separated depth -> [n, inputs]
+    return patches.reshape(patches.shape[0], -1).astype(np.float32)
+
+
+def export(filename, layers, mean, std, classes):
+    arrays = {'mean': np.asarray(mean, np.float32), 'std': np.maximum(np.asarray(std, np.float32), 1e-6),
+              'classes': np.asarray(classes)}
+    for i, (w, b) in enumerate(layers):
+        arrays['w' + str(i)] = np.asarray(w, np.float32)
+        arrays['b' + str(i)] = np.asarray(b, np.float32)
+    np.savez(filename, **arrays)
+
+
+class Classifier:
+    # classifies the patch history around touch candidates, decisions are smoothed per button.
+    # inference that overruns the per frame budget is paid back by skipping frames.
+
+    def __init__(self, conf):
+        self.region = conf.train_region
+        self.frames = conf.train_frames
+        self.compression = conf.sampling_reduction
+        self.roi = Calibration.full_roi(conf.img_h, conf.img_w)
+        self.budget = conf.classify_budget / 1000
+        self.max_candidates = conf.classify_max_candidates
+        self.alpha = conf.classify_alpha
+        self.on = conf.classify_on
+        self.off = conf.classify_off
+
+        self.layers = []
+        self.classes = []
+        self.mean = None
+        self.std = None
+        if CameraBase.file_exists(conf.classify_model):
+            self.load(conf.classify_model)
+        else:
+            print('Warning: no classifier model ' + conf.classify_model + ', classification disabled')
+
+        # last frames of result_depth, count is the number of frames pushed
+        self.ring = None
+        self.count = 0
+        self.skip = 0
+        self.offsets = np.arange(-self.region, self.region)
+
+        # smoothed probability per button and class, decided class per button (-1 none)
+        self.smooth = np.zeros((0, len(self.classes)), np.float32)
+        self.decided = np.zeros(0, np.int64)
+
+    @property
+    def enabled(self):
+        return len(self.layers) > 0
+
+    def load(self, filename):
+        with np.load(filename) as data:
+            n = len([key for key in data.files if key.startswith('w')])
+            self.layers = [(data['w' + str(i)], data['b' + str(i)]) for i in range(0, n)]
+            self.mean = data['mean']
+            self.std = data['std']
+            self.classes = [str(c) for c in data['classes']]
+
+    def set_roi(self, roi):
+        self.roi = roi
+        self.reset()
+
+    def reset(self):
+        self.ring = None
+        self.count = 0
+        self.skip = 0
+        self.smooth[:] = 0
+        self.decided[:] = -1
+
+    def push(self, result_depth):
+        if self.ring is None or self.ring.shape[1:] != result_depth.shape:
+            self.ring = np.zeros((self.frames,) + result_depth.shape, np.uint16)
+            self.count = 0
+        self.ring[self.count % self.frames] = result_depth
+        self.count += 1
+
+    def patches(self, blobs):
+        # [n, frames, size, size] around the blobs (full resolution camera pixels), oldest frame first
+        h, w = self.ring.shape[1:]
+        cx = np.clip(((blobs[:, 0] - self.roi[0]) / self.compression).astype(np.int64), self.region, w - self.region)
+        cy = np.clip(((blobs[:, 1] - self.roi[1]) / self.compression).astype(np.int64), self.region, h - self.region)
+        order = (self.count + np.arange(0, self.frames)) % self.frames
+        return self.ring[order[np.newaxis, :, np.newaxis, np.newaxis],
+                         (cy[:, np.newaxis] + self.offsets)[:, np.newaxis, :, np.newaxis],
+                         (cx[:, np.newaxis] + self.offsets)[:, np.newaxis, np.newaxis, :]]
+
+    def predict(self, x):
+        # [n, inputs] features -> [n, classes] probabilities
+        x = (x - self.mean) / self.std
+        for w, b in self.layers[:-1]:
+            x = np.maximum(x @ w + b, 0)
+        w, b = self.layers[-1]
+        z = x @ w + b
+        if z.shape[1] == 1:
+            return 1 / (1 + np.exp(-z))
+        z = np.exp(z - z.max(axis=1, keepdims=True))
+        return z / z.sum(axis=1, keepdims=True)
+
+    def update(self, result_depth, touch):
+        # run after touch.update, returns a list of (button, class | None, vid_x, vid_y) on decision changes
+        if not self.enabled:
+            return []
+        self.push(result_depth)
+        if len(self.decided) != len(touch.buttons):
+            self.smooth = np.zeros((len(touch.buttons), len(self.classes)), np.float32)
+            self.decided = np.full(len(touch.buttons), -1, np.int64)
+        if self.count < self.frames:
+            return []
+        if self.skip > 0:
+            self.skip -= 1
+            return []
+
+        start = time.perf_counter()
+        blobs, points = touch.blobs, touch.points
+        # candidates on a button only, the largest first
+        dist = np.linalg.norm(points[:, np.newaxis, :] - touch.centers[np.newaxis, :, :], axis=2)
+        inside = dist <= touch.radii[np.newaxis, :]
+        candidates = np.flatnonzero(inside.any(axis=1))
+        candidates = candidates[np.argsort(-blobs[candidates, 2])][0:self.max_candidates]
+
+        prob = np.zeros((len(touch.buttons), len(self.classes)), np.float32)
+        if len(candidates) > 0:
+            p = self.predict(features(self.patches(blobs[candidates])))
+            # every button takes the most confident candidate on it
+            for k, i in enumerate(candidates):
+                prob[inside[i]] = np.maximum(prob[inside[i]], p[k])
+        self.smooth += self.alpha * (prob - self.smooth)
+
+        # hysteresis per button
+        best = np.argmax(self.smooth, axis=1)
+        level = self.smooth[np.arange(len(best)), best]
+        held = np.where(self.decided >= 0, self.smooth[np.arange(len(best)), np.maximum(self.decided, 0)], 0)
+        decided = np.where((self.decided >= 0) & (held >= self.off), self.decided, -1)
+        decided = np.where((decided < 0) & (level >= self.on), best, decided)
+
+        events = []
+        for i in np.flatnonzero(decided != self.decided):
+            label = self.classes[decided[i]] if decided[i] >= 0 else None
+            events.append((touch.buttons[i], label, float(touch.centers[i, 0]), float(touch.centers[i, 1])))
+        self.decided = decided
+
+        # frames to skip until the time over budget is paid back
+        elapsed = time.perf_counter() - start
+        self.skip = int(elapsed / self.budget) if elapsed > self.budget else 0
+        return events
@@ -6,12 +6,40 @@ class Config:
 
     # Processing Variables
     vid_h, vid_w = (430, 790)
+    # origin of the lookup table in the projector space, set per camera from vid_area
+    vid_offset = (0, 0)
     sampling_reduction = 2
+    # crop the per frame stages to the calibrated projector footprint plus margin [px]
+    use_roi = True
+    roi_margin = 8
     view_reduction = 1
-    sleeptime = 0.5
+    # frames to wait for the projection to settle in calibration and training
+    settle_frames = 15
+
+    # Run state without worker processes: only tiles whose depth moved by more than
+    # max(change_threshold [mm], change_relative * depth) in over change_min_pixels pixels are
+    # reprocessed, a full pass if more than change_full_ratio of the tiles changed. tiles in reduced px
+    use_changes = True
+    change_tile = 16
+    change_threshold = 8
+    change_relative = 0.01
+    change_min_pixels = 2
+    change_full_ratio = 0.5
+
+    # worker processes for the Run state, 0 processes in the main loop
+    pool_workers = 0
 
     # Processor: BG Separation
     clipping_tolerance = 10
+    # adaptive background: ema weight, noise margin in std deviations, update every n frames
+    bg_adaptive = True
+    bg_alpha = 0.02
+    bg_sigmas = 3.0
+    bg_update_interval = 5
+    # thresholds closer than this [mm] to the one in use are ignored, keeps noise from re-eroding the whole image
+    bg_deadband = 2.0
+    # fused kernel via numba if installed, numpy otherwise
+    use_numba = True
 
     # Processor: Min Distance
     min_distance = 200
@@ -19,16 +47,97 @@ class Config:
     # Processor: Brightness
     brightness_limit = 0
 
+    # Touch: height band above the background, min blob area (reduced pixels), debounce frames
+    touch_min_height = 3
+    touch_max_height = 40
+    touch_min_area = 15
+    touch_press_frames = 2
+    touch_release_frames = 3
+    # touch classifier exported by Classifier.export, disabled if the file does not exist
+    classify_model = './classifier.npz'
+    # ms per frame, overruns are paid back by skipping frames
+    classify_budget = 2.0
+    classify_max_candidates = 32
+    # smoothing weight of the newest frame, hysteresis thresholds on the smoothed probability
+    classify_alpha = 0.5
+    classify_on = 0.7
+    classify_off = 0.4
+
     # Camera Parameters
     img_h, img_w = (480, 640)
     fps = 30
+    # realsense depth stream (w, h), None uses img_w x img_h. the color stream is always img_w x img_h
+    rs_depth_size = None
+    # depth registration: 'color' full frame rs.align, 'roi' remap of the calibrated roi only, 'none'
+    rs_align = 'color'
+    # librealsense post processing of the depth stream, decimation magnitude 1 is off
+    rs_decimation = 1
+    rs_spatial = False
+    rs_temporal = False
+    rs_hole_filling = False
+    # 'realsense' or 'replay' of a session written by the Record state
+    camera_backend = 'realsense'
+    # realsense serial number, empty for the first device found
+    camera_serial = ''
+    # several cameras: one dict of Config overrides per camera, e.g. camera_serial, calib_file and
+    # vid_area (x0, y0, x1, y1), the part of the projector space the camera is calibrated to.
+    # without a calib_file override the camera's index is appended, ./calib_0.lut for the first.
+    # empty for a single camera covering all of vid_w x vid_h
+    cameras = ()
+    # detections of different cameras closer than fuse_radius [projector px] are one touch,
+    # weighted down within blend_width of a camera's area border. results fused within fuse_window [ms]
+    fuse_radius = 30
+    blend_width = 40
+    fuse_window = 20
+    replay_path = './recordings/session/'
+    replay_realtime = True
+    replay_loop = True
+    replay_preload = False
+    record_path = './recordings/session/'
+    # raw frames per npz chunk [MB], the recorder holds two chunks in memory
+    record_chunk_mb = 32
+    # capture on a background thread into a ring of frame slots
+    async_acquisition = True
+    ring_slots = 4
     train_loops = 100
     train_region = 10
     train_frames = 15
+    # samples per compressed shard in TRAIN_PATH
+    train_shard = 64
     calib_brightness_limit = 0.7
     calib_separation_limit = 0.15
+    # frames per dot, seconds to wait for a dot to (dis)appear, pixels that count as a dot
+    calib_burst = 5
+    calib_timeout = 2.0
+    calib_min_pixels = 10
+    # dots per row/column and projector area (x0, y0, x1, y1) they span
+    calib_grid = (3, 3)
+    calib_area = (25, 25, 725, 375)
+    # 'bilinear' (needs a full dot grid) or 'homography'
+    calib_method = 'bilinear'
+    calib_file = './calib.lut'
+    calib_verify = True
+    # csv pair, migrated on first start and written on calibration if enabled
     calib_file_x = './calib_x.csv'
     calib_file_y = './calib_y.csv'
+    calib_export_csv = False
+
+    # Stage timing: samples kept per stage, frames between percentile updates,
+    # export file (.csv or json lines) and prometheus port, both off when empty/0
+    tick_window = 300
+    tick_refresh = 15
+    tick_export = ''
+    tick_port = 0
 
     # Display
     fullscreen = False
+    # no local window, keys only via the stream server
+    headless = False
+
+    # Stream server for remote monitoring, off with port 0: the window as mjpeg at
+    # stream_fps and stream_scale, touch events and stage metrics as server sent events
+    stream_port = 0
+    stream_host = '127.0.0.1'
+    stream_fps = 10
+    stream_scale = 0.5
+    stream_quality = 70
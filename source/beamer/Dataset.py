@@ -0,0 +1,142 @@
+import glob
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# training samples are stored in compressed npz shards of up to train_shard samples:
+#   patches     uint16  [n, train_frames, 2 * train_region, 2 * train_region]  background separated depth
+#   vid         int32   [n, 2]  projector (x, y) of the target
+#   cam         int32   [n, 2]  reduced camera (x, y) the patches are centred on
+#   timestamps  float64 [n, train_frames]  capture time of every patch [s]
+fields = ('patches', 'vid', 'cam', 'timestamps')
+
+
+class DatasetWriter:
+    # collects samples in memory and compresses full shards on a background thread
+
+    def __init__(self, conf):
+        self.path = conf.TRAIN_PATH
+        self.shard_size = conf.train_shard
+        self.frames = conf.train_frames
+        self.size = 2 * conf.train_region
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = None
+        self.prefix = ''
+        self.shard_index = 0
+        self.count = 0
+        self.samples = 0
+        self.shard = None
+
+    def allocate(self):
+        return {'patches': np.zeros((self.shard_size, self.frames, self.size, self.size), np.uint16),
+                'vid': np.zeros((self.shard_size, 2), np.int32),
+                'cam': np.zeros((self.shard_size, 2), np.int32),
+                'timestamps': np.zeros((self.shard_size, self.frames))}
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        # one prefix per session, earlier sessions in the same folder are kept
+        self.prefix = time.strftime('%Y%m%d-%H%M%S')
+        self.shard_index = 0
+        self.count = 0
+        self.samples = 0
+        self.shard = self.allocate()
+        self.thread = threading.Thread(target=self.write, name='dataset-writer', daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        # views to fill for the next sample: patches, vid, cam, timestamps
+        return tuple(self.shard[key][self.count] for key in fields)
+
+    def commit(self):
+        self.count += 1
+        self.samples += 1
+        if self.count == self.shard_size:
+            self.flush()
+
+    def add(self, patches, vid, cam, timestamps):
+        for target, value in zip(self.sample(), (patches, vid, cam, timestamps)):
+            target[...] = value
+        self.commit()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        outfile = os.path.join(self.path, self.prefix + '_shard_' + str(self.shard_index).zfill(5) + '.npz')
+        # blocks only if two shards are still waiting for the writer
+        self.queue.put((outfile, {key: data[0:self.count] for key, data in self.shard.items()}))
+        self.shard = self.allocate()
+        self.shard_index += 1
+        self.count = 0
+
+    def write(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            outfile, shard = job
+            np.savez_compressed(outfile, **shard)
+
+    def stop(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class DatasetReader:
+    # lazy access to all shards in a folder, shards are decompressed on first use
+
+    def __init__(self, path, cache_shards=2):
+        self.files = sorted(glob.glob(os.path.join(path, '*_shard_*.npz')))
+        self.cache_shards = cache_shards
+        self.cache = {}
+        self.lengths = []
+        for f in self.files:
+            with np.load(f) as data:
+                # only the small vid array is decompressed
+                self.lengths.append(data['vid'].shape[0])
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths))).astype(np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, i):
+        if i not in self.cache:
+            if len(self.cache) >= self.cache_shards:
+                self.cache.pop(next(iter(self.cache)))
+            with np.load(self.files[i]) as data:
+                self.cache[i] = {key: data[key] for key in fields}
+        return self.cache[i]
+
+    def batches(self, batch_size, fields_out=fields):
+        # yields dicts of consecutive samples, batches may span shards
+        parts = []
+        filled = 0
+        for i in range(0, len(self.files)):
+            shard = self.shard(i)
+            start = 0
+            while start < self.lengths[i]:
+                take = min(batch_size - filled, self.lengths[i] - start)
+                parts.append({key: shard[key][start:start + take] for key in fields_out})
+                filled += take
+                start += take
+                if filled == batch_size:
+                    yield self.join(parts, fields_out)
+                    parts = []
+                    filled = 0
+        if filled > 0:
+            yield self.join(parts, fields_out)
+
+    @staticmethod
+    def join(parts, fields_out):
+        if len(parts) == 1:
+            return parts[0]
+        return {key: np.concatenate([p[key] for p in parts]) for key in fields_out}
+
+    def load(self, fields_out=fields):
+        return self.join([{key: self.shard(i)[key] for key in fields_out} for i in range(0, len(self.files))],
+                         fields_out) if len(self.files) > 0 else None
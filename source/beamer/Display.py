@@ -1,6 +1,9 @@
+import queue
 import numpy as np
 import cv2
 
+import Calibration
+
 class Display:
     # internal
     view_reduction = 0
@@ -18,50 +21,140 @@ class Display:
         self.compression = conf.sampling_reduction
         self.view_reduction = conf.view_reduction
         self.fullscreen = conf.fullscreen
+        # no window, keys come from press, e.g. by the stream server
+        self.headless = conf.headless
+        self.keys = queue.Queue()
+        self.roi = Calibration.full_roi(self.img_h, self.img_w)
+        self.depth_colormap = None
+
+        # static layer (buttons, borders, menu text), drawn once and kept to restore overlays from
+        self.static_img = np.zeros((conf.vid_h, conf.vid_w, 3), np.uint8)
+        # rectangles (x0, y0, x1, y1) of insitu_img changed since the last show
+        self.dirty = [(0, 0, self.vid_w, self.vid_h)]
+        self.window = False
+
+        # info overlay, re-rendered only when its text changes
+        self.info_text = None
+        self.info_img = np.zeros((0, 400, 3), np.uint8)
+        self.info_org = (10, 140)
+
+    def mark(self, x0, y0, x1, y1):
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), self.vid_w), min(int(y1), self.vid_h)
+        if x0 < x1 and y0 < y1:
+            self.dirty.append((x0, y0, x1, y1))
+
+    def is_dirty(self, x0, y0, x1, y1):
+        return any(x0 < dx1 and dx0 < x1 and y0 < dy1 and dy0 < y1 for dx0, dy0, dx1, dy1 in self.dirty)
 
     def clear(self):
-        cv2.rectangle(self.insitu_img,
-                      pt1=(0, 0),
-                      pt2=(self.vid_w, self.vid_h),
-                      color=(0, 0, 0),
-                      thickness=-1)
+        self.static_img.fill(0)
+        self.insitu_img.fill(0)
+        self.info_text = None
+        self.info_img = self.info_img[0:0]
+        self.mark(0, 0, self.vid_w, self.vid_h)
 
     def add_button(self, cx, cy, r, col):
-        cv2.circle(self.insitu_img, center=(cx, cy), radius=r, color=col, thickness=-1)
+        for img in (self.static_img, self.insitu_img):
+            cv2.circle(img, center=(cx, cy), radius=r, color=col, thickness=-1)
+        self.mark(cx - r, cy - r, cx + r + 1, cy + r + 1)
 
     def add_border(self, cx, cy, w, h):
-        cv2.rectangle(self.insitu_img,
-                      pt1=(cx, cy),
-                      pt2=(int((cx+w)/self.view_reduction) + 2*self.padding, int((cy+h)/self.view_reduction) + 2*self.padding),
-                      color=self.border_color,
-                      thickness=self.border_thickness)
+        pt2 = (int((cx+w)/self.view_reduction) + 2*self.padding, int((cy+h)/self.view_reduction) + 2*self.padding)
+        for img in (self.static_img, self.insitu_img):
+            cv2.rectangle(img,
+                          pt1=(cx, cy),
+                          pt2=pt2,
+                          color=self.border_color,
+                          thickness=self.border_thickness)
+        t = self.border_thickness
+        self.mark(cx - t, cy - t, pt2[0] + t + 1, pt2[1] + t + 1)
 
     def update_streams(self, depth_img, color_img):
-        reduced_color = color_img[0:color_img.shape[0]:self.view_reduction, 0:color_img.shape[1]:self.view_reduction, :]
-        reduced_depth = depth_img[0:depth_img.shape[0]:self.view_reduction, 0:depth_img.shape[1]:self.view_reduction, :]
-        images = np.hstack((reduced_color, reduced_depth))
-        self.insitu_img[self.padding:images.shape[0]+self.padding, self.padding:images.shape[1]+self.padding, :] = images
+        # strided views written straight into the canvas, clipped to it
+        h = min(len(range(0, color_img.shape[0], self.view_reduction)), self.vid_h - self.padding)
+        w = len(range(0, color_img.shape[1], self.view_reduction))
+        x0 = self.padding
+        for img in (color_img, depth_img):
+            cw = min(w, self.vid_w - x0)
+            if cw <= 0:
+                break
+            self.insitu_img[self.padding:self.padding + h, x0:x0 + cw, :] = \
+                img[0:h * self.view_reduction:self.view_reduction, 0:cw * self.view_reduction:self.view_reduction, :]
+            x0 += w
+        self.mark(self.padding, self.padding, x0, self.padding + h)
 
     def update_info(self, info):
-        img_info = np.zeros((20, 400, 3))
-        cv2.putText(img_info, text=info, org=(0, 15), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.5, color=(200, 0, 0), thickness=1, lineType=cv2.LINE_AA)
-        self.insitu_img[140:160, 10:410, :] = img_info
+        # one line of text or a list of lines, 20 px each
+        if isinstance(info, str):
+            info = [info]
+        x0, y0 = self.info_org
+        if info != self.info_text:
+            old_h = self.info_img.shape[0]
+            if len(info) * 20 != old_h:
+                self.info_img = np.zeros((20 * len(info), 400, 3), np.uint8)
+            else:
+                self.info_img.fill(0)
+            for i, line in enumerate(info):
+                cv2.putText(self.info_img, text=line, org=(0, 20 * i + 15), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.5, color=(200, 0, 0), thickness=1, lineType=cv2.LINE_AA)
+            if old_h > self.info_img.shape[0]:
+                # fewer lines than before, bring back what is below
+                self.insitu_img[y0:y0 + old_h, x0:x0 + 400] = self.static_img[y0:y0 + old_h, x0:x0 + 400]
+                self.mark(x0, y0, x0 + 400, y0 + old_h)
+            self.info_text = list(info)
+        elif not self.is_dirty(x0, y0, x0 + 400, y0 + self.info_img.shape[0]):
+            return
+        h = min(self.info_img.shape[0], self.vid_h - y0)
+        self.insitu_img[y0:y0 + h, x0:x0 + 400] = self.info_img[0:h]
+        self.mark(x0, y0, x0 + 400, y0 + h)
 
     def add_static_text(self, txt, xpos, ypos, color, scale):
-        cv2.putText(self.insitu_img, text=txt, org=(xpos, ypos), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=scale, color=color, thickness=1, lineType=cv2.LINE_AA)
+        for img in (self.static_img, self.insitu_img):
+            cv2.putText(img, text=txt, org=(xpos, ypos), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=scale, color=color, thickness=1, lineType=cv2.LINE_AA)
+        (w, h), baseline = cv2.getTextSize(txt, cv2.FONT_HERSHEY_SIMPLEX, scale, 1)
+        self.mark(xpos, ypos - h - 1, xpos + w + 1, ypos + baseline + 1)
 
-    def show(self):
+    def open_window(self):
         if self.fullscreen:
             cv2.namedWindow('RealSense', cv2.WND_PROP_FULLSCREEN)
             cv2.setWindowProperty('RealSense', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
         else:
             cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', self.insitu_img)
-        return cv2.waitKey(1)
+        self.window = True
+
+    def press(self, key):
+        self.keys.put(key)
+
+    def show(self, delay=1):
+        # the window is only redrawn if something changed, waits up to delay ms for a key
+        if self.headless:
+            self.dirty = []
+            try:
+                return self.keys.get(timeout=delay / 1000)
+            except queue.Empty:
+                return -1
+        if not self.window:
+            self.open_window()
+        if self.dirty:
+            cv2.imshow('RealSense', self.insitu_img)
+            self.dirty = []
+        return cv2.waitKey(delay)
 
     def color_depth_from_frame(self, depth_frame):
-        depth_image = np.asanyarray(depth_frame.get_data())[0:self.img_h:self.compression, 0:self.img_w:self.compression]
-        return cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_PINK)
+        return self.color_depth_reduced(np.asanyarray(depth_frame.get_data()))
+
+    def set_roi(self, roi):
+        self.roi = roi
+
+    def color_depth_reduced(self, depth_image, tiles=None):
+        # tiles is a list of (y0, y1, x0, x1) to recolour, the rest of the last colormap is kept
+        depth_image = Calibration.crop(depth_image, self.roi, self.compression)
+        if tiles is None or self.depth_colormap is None or self.depth_colormap.shape[0:2] != depth_image.shape:
+            self.depth_colormap = self.color_depth_from_image(depth_image)
+            return self.depth_colormap
+        for y0, y1, x0, x1 in tiles:
+            self.depth_colormap[y0:y1, x0:x1] = self.color_depth_from_image(depth_image[y0:y1, x0:x1])
+        return self.depth_colormap
 
     def color_depth_from_image(self, depth_image):
         return cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_PINK)
@@ -70,4 +163,7 @@ class Display:
         self.show()
 
     def stop(self):
-        cv2.destroyAllWindows()
\ No newline at end of file
+        if self.headless:
+            return
+        cv2.destroyAllWindows()
+        self.window = False
\ No newline at end of file
@@ -0,0 +1,34 @@
+import numpy as np
+
+# dtype policy of the frame pipeline. the per frame stages check their inputs against it, so a
+# stage that silently widens to float64 or an int that wraps around fails where it happens.
+#   depth   uint16   [mm], 0 is no reading, arithmetic saturates at 0
+#   color   uint8    BGR
+#   grey    uint8    cv2.cvtColor of color, thresholds scaled by 255
+#   coord   float32  camera and projector coordinates, lookup tables
+# timestamps stay float64, camera clocks in ms since the epoch do not fit a float32.
+depth = np.uint16
+color = np.uint8
+grey = np.uint8
+coord = np.float32
+
+
+def check(name, array, dtype):
+    # raises TypeError if array is not of dtype, returns it unchanged otherwise
+    if array.dtype != dtype:
+        raise TypeError(name + ' must be ' + np.dtype(dtype).name + ', got ' + array.dtype.name)
+    return array
+
+
+def subtract(depth_image, value, out=None):
+    # depth_image - value, 0 where it would wrap around. strided views are copied once, the rest is in place
+    if out is None:
+        out = np.empty(depth_image.shape, depth_image.dtype)
+    np.copyto(out, depth_image)
+    np.maximum(out, value, out=out)
+    return np.subtract(out, value, out=out)
+
+
+def coords(points):
+    # (n, 2) coordinates as coord, no copy if they already are
+    return np.asarray(points, dtype=coord).reshape(-1, 2)
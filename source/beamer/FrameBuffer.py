@@ -0,0 +1,78 @@
+import threading
+import numpy as np
+
+import Dtypes
+
+
+class FrameBuffer:
+    # single producer, single consumer ring of preallocated frame slots.
+    # the slot handed to the consumer stays untouched until the next get call.
+
+    def __init__(self, slots, img_h, img_w):
+        if slots < 3:
+            raise ValueError('FrameBuffer needs at least 3 slots')
+        self.slots = slots
+        self.depth = np.zeros((slots, img_h, img_w), Dtypes.depth)
+        self.color = np.zeros((slots, img_h, img_w, 3), Dtypes.color)
+        self.frame_number = np.full(slots, -1, np.int64)
+        self.timestamp = np.zeros(slots)
+        self.fresh = np.zeros(slots, bool)
+
+        self.cond = threading.Condition()
+        self.write_slot = 0
+        self.read_slot = -1
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+
+    def write(self, depth_image, color_image, frame_number, timestamp):
+        # copy outside the lock, the slot is neither fresh nor held by the consumer
+        slot = self.write_slot
+        self.depth[slot] = depth_image
+        self.color[slot] = color_image
+        with self.cond:
+            self.frame_number[slot] = frame_number
+            self.timestamp[slot] = timestamp
+            self.fresh[slot] = True
+            self.written += 1
+            self.write_slot = self.next_write_slot(slot)
+            self.cond.notify_all()
+
+    def next_write_slot(self, slot):
+        slot = (slot + 1) % self.slots
+        if slot == self.read_slot:
+            slot = (slot + 1) % self.slots
+        if self.fresh[slot]:
+            # consumer fell behind, the oldest unread frame gets overwritten
+            self.fresh[slot] = False
+            self.dropped += 1
+        return slot
+
+    def close(self):
+        # wake up a waiting consumer, the producer is gone
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get_latest(self, timeout=1.0):
+        with self.cond:
+            self.cond.wait_for(lambda: self.fresh.any() or self.closed, timeout)
+            if not self.fresh.any():
+                return None
+            slot = int(np.argmax(np.where(self.fresh, self.frame_number, -1)))
+            self.dropped += int(np.count_nonzero(self.fresh)) - 1
+            self.fresh[:] = False
+            return self.claim(slot)
+
+    def get_next(self, timeout=1.0):
+        with self.cond:
+            self.cond.wait_for(lambda: self.fresh.any() or self.closed, timeout)
+            if not self.fresh.any():
+                return None
+            slot = int(np.argmin(np.where(self.fresh, self.frame_number, np.iinfo(np.int64).max)))
+            self.fresh[slot] = False
+            return self.claim(slot)
+
+    def claim(self, slot):
+        self.read_slot = slot
+        return self.depth[slot], self.color[slot], int(self.frame_number[slot]), float(self.timestamp[slot])
@@ -0,0 +1,181 @@
+import copy
+import os
+import threading
+import numpy as np
+
+import Background
+import Calibration
+import Dtypes
+import Processors
+import TouchDetector
+
+
+def camera_confs(conf):
+    # one Config per camera, conf itself for a single camera
+    if not conf.cameras:
+        return [conf]
+    confs = []
+    for index, overrides in enumerate(conf.cameras):
+        c = copy.copy(conf)
+        c.cameras = ()
+        for key, value in overrides.items():
+            setattr(c, key, value)
+        x0, y0, x1, y1 = overrides.get('vid_area', (0, 0, conf.vid_w, conf.vid_h))
+        # the lookup table covers the camera's area of the projector space only
+        c.vid_offset = (x0, y0)
+        c.vid_w, c.vid_h = x1 - x0, y1 - y0
+        if 'calib_area' not in overrides:
+            m = conf.calib_area[0]
+            c.calib_area = (m, m, c.vid_w - m, c.vid_h - m)
+        # every camera has its own tables, calib.lut becomes calib_0.lut, calib_1.lut, ...
+        for key in ('calib_file', 'calib_file_x', 'calib_file_y'):
+            if key not in overrides:
+                root, ext = os.path.splitext(getattr(conf, key))
+                setattr(c, key, root + '_' + str(index) + ext)
+        confs.append(c)
+    return confs
+
+
+class CameraWorker:
+    # processing of one camera on its own thread: background, separation, blobs in projector coordinates.
+    # numpy, cv2 and the numba kernel release the GIL, so cameras run in parallel
+
+    def __init__(self, index, cam, cond):
+        conf = cam.conf
+        self.index = index
+        self.cam = cam
+        self.cond = cond
+        self.proc = Processors.Processors(conf)
+        self.touch = TouchDetector.TouchDetector(conf)
+        self.bgm = Background.Background(conf) if conf.bg_adaptive else None
+        self.compression = conf.sampling_reduction
+        self.offset = np.array(conf.vid_offset, Dtypes.coord)
+        self.size = np.array((conf.vid_w, conf.vid_h), Dtypes.coord)
+        self.blend_width = conf.blend_width
+
+        # newest result (timestamp, frame_number, points, weights, result_img, depth), replaced as a whole
+        self.result = None
+        self.serial = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        roi = self.cam.roi
+        for stage in (self.proc, self.touch, self.bgm):
+            if stage is not None:
+                stage.set_roi(roi)
+        self.roi = roi
+        self.result = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='camera-' + str(self.index), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        background_img = None
+        try:
+            while self.running:
+                frame = self.cam.wait_frame(True, 0.5)
+                if frame is None:
+                    continue
+                depth_image, color_image, frame_number, timestamp = frame
+
+                if background_img is None:
+                    background_img = self.proc.generate_background_from_image(depth_image) if self.bgm is None \
+                        else self.bgm.reset(depth_image)
+                elif self.bgm is not None:
+                    self.bgm.update(depth_image)
+                result_img, result_depth_3d = self.proc.process_images(depth_image, color_image, background_img)
+                blobs = self.touch.detect(result_depth_3d[:, :, 0], background_img)
+                points = self.cam.camera_to_projector(blobs[:, 0:2])
+                points = points[~np.isnan(points).any(axis=1)]
+
+                # full weight away from the border of the camera's area, fading out towards it
+                local = points - self.offset
+                edge = np.minimum(local, self.size - local).min(axis=1)
+                weights = np.clip(edge / self.blend_width, 0.05, 1.0)
+                result = (timestamp, frame_number, points, weights, result_img.copy(),
+                          Calibration.crop(depth_image, self.roi, self.compression).copy())
+                with self.cond:
+                    self.result = result
+                    self.serial += 1
+                    self.cond.notify_all()
+        except EOFError:
+            pass
+        finally:
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+
+
+class CameraGroup:
+    # runs one CameraWorker per camera and fuses their newest results into one touch frame
+
+    def __init__(self, conf, cams):
+        self.cond = threading.Condition()
+        self.workers = [CameraWorker(i, cam, self.cond) for i, cam in enumerate(cams)]
+        self.fuse_radius = conf.fuse_radius
+        self.fuse_window = conf.fuse_window
+        self.seen = [0] * len(self.workers)
+
+    def start(self):
+        self.seen = [0] * len(self.workers)
+        for w in self.workers:
+            w.start()
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+
+    def fresh(self):
+        return [w.serial > s for w, s in zip(self.workers, self.seen)]
+
+    def wait_frame(self, timeout):
+        # (points, result_img, depth, frame_number, timestamp) of the fused frame, None on timeout.
+        # waits for the first new result, then up to fuse_window for the other cameras
+        with self.cond:
+            if not self.cond.wait_for(lambda: any(self.fresh()) or not any(w.running for w in self.workers), timeout):
+                return None
+            if not any(self.fresh()):
+                raise EOFError('Camera stream ended')
+            self.cond.wait_for(lambda: all(f or not w.running for f, w in zip(self.fresh(), self.workers)),
+                               self.fuse_window / 1000)
+            results = [w.result for w in self.workers]
+            self.seen = [w.serial for w in self.workers]
+
+        newest = max(r[0] for r in results if r is not None)
+        points, weights, cams = [], [], []
+        for i, r in enumerate(results):
+            # results too old for this frame are left out
+            if r is not None and newest - r[0] <= self.fuse_window:
+                points.append(r[2])
+                weights.append(r[3])
+                cams.append(np.full(len(r[2]), i))
+        points = self.fuse(np.concatenate(points), np.concatenate(weights), np.concatenate(cams))
+        first = results[0] if results[0] is not None else next(r for r in results if r is not None)
+        return points, first[4], first[5], first[1], newest
+
+    def fuse(self, points, weights, cams):
+        # detections of different cameras within fuse_radius are merged, weighted by their distance to the border
+        order = np.argsort(-weights)
+        sums, totals, members = [], [], []
+        for i in order:
+            for k in range(0, len(sums)):
+                if cams[i] not in members[k] and \
+                        np.linalg.norm(sums[k] / totals[k] - points[i]) <= self.fuse_radius:
+                    sums[k] = sums[k] + weights[i] * points[i]
+                    totals[k] += weights[i]
+                    members[k].add(cams[i])
+                    break
+            else:
+                sums.append(weights[i] * points[i])
+                totals.append(weights[i])
+                members.append({cams[i]})
+        if len(sums) == 0:
+            return np.zeros((0, 2), Dtypes.coord)
+        return (np.array(sums) / np.array(totals)[:, np.newaxis]).astype(Dtypes.coord)
@@ -0,0 +1,169 @@
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+
+import Calibration
+import Dtypes
+import Processors
+
+
+class SharedFrames:
+    # one block of shared memory holding all slots: input frames, results and the background
+
+    def __init__(self, slots, img_h, img_w, compression, name=None):
+        res_h = len(range(0, img_h, compression))
+        res_w = len(range(0, img_w, compression))
+        self.layout = [('depth', (slots, img_h, img_w), Dtypes.depth),
+                       ('color', (slots, img_h, img_w, 3), Dtypes.color),
+                       ('result_img', (slots, res_h, res_w, 3), Dtypes.color),
+                       ('result_depth', (slots, res_h, res_w), Dtypes.depth),
+                       ('background', (res_h, res_w), Dtypes.depth)]
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for key, shape, dtype in self.layout)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        offset = 0
+        for key, shape, dtype in self.layout:
+            array = np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, key, array)
+            offset += array.nbytes
+
+    def close(self):
+        for key, shape, dtype in self.layout:
+            setattr(self, key, None)
+        self.shm.close()
+
+
+def worker(conf, slots, name, tasks, results):
+    frames = SharedFrames(slots, conf.img_h, conf.img_w, conf.sampling_reduction, name)
+    proc = Processors.Processors(conf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, frame_number, roi = task
+            # results go straight into the shared slot, its top left corner when cropped to the roi
+            res_h, res_w = Calibration.crop_shape(roi, conf.sampling_reduction)
+            proc.set_roi(roi)
+            proc.set_output(frames.result_img[slot, 0:res_h, 0:res_w], frames.result_depth[slot, 0:res_h, 0:res_w])
+            proc.process_images(frames.depth[slot], frames.color[slot], frames.background[0:res_h, 0:res_w])
+            results.put((slot, frame_number))
+    finally:
+        proc = None
+        frames.close()
+
+
+class ProcessingPool:
+    # runs Processors.process_images on worker processes, frames travel through shared memory.
+    # get returns results in submission order and blocks while the oldest one is still being processed,
+    # callers keep at most pool_workers frames pending.
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.workers = conf.pool_workers
+        # one slot per worker in flight, one finished ahead, one held by the consumer
+        self.slots = conf.pool_workers + 2
+        self.frames = None
+        self.processes = []
+        self.tasks = None
+        self.results = None
+        self.free = []
+        self.done = {}
+        self.held = None
+        self.submitted = 0
+        self.delivered = 0
+        self.roi = Calibration.full_roi(conf.img_h, conf.img_w)
+        self.rois = {}
+
+    def start(self):
+        ctx = mp.get_context('spawn')
+        self.frames = SharedFrames(self.slots, self.conf.img_h, self.conf.img_w, self.conf.sampling_reduction)
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = [ctx.Process(target=worker, name='processing-' + str(i),
+                                      args=(self.conf, self.slots, self.frames.shm.name, self.tasks, self.results),
+                                      daemon=True)
+                          for i in range(0, self.workers)]
+        for p in self.processes:
+            p.start()
+        self.free = list(range(0, self.slots))
+        self.rois = {}
+        self.done = {}
+        self.held = None
+        self.submitted = 0
+        self.delivered = 0
+
+    def stop(self):
+        for p in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        if self.frames is not None:
+            self.free = []
+            self.done = {}
+            self.held = None
+            try:
+                self.frames.close()
+            except BufferError:
+                # a result view is still referenced, the block goes away with it
+                pass
+            self.frames.shm.unlink()
+            self.frames = None
+
+    def set_roi(self, roi):
+        # applies to frames submitted from now on
+        self.roi = roi
+
+    def set_background(self, bg_image):
+        # workers read it in place, a frame in flight may see part old and part new background
+        self.frames.background[0:bg_image.shape[0], 0:bg_image.shape[1]] = bg_image
+
+    def pending(self):
+        return self.submitted - self.delivered
+
+    def submit(self, depth_image, color_image):
+        if len(self.free) == 0:
+            raise RuntimeError('No free slot in the processing pool, get results first')
+        slot = self.free.pop()
+        self.frames.depth[slot] = depth_image
+        self.frames.color[slot] = color_image
+        self.tasks.put((slot, self.submitted, self.roi))
+        self.rois[self.submitted] = self.roi
+        self.submitted += 1
+        return self.submitted - 1
+
+    def collect(self, block):
+        try:
+            slot, frame_number = self.results.get(block=block, timeout=1.0 if block else None)
+        except queue.Empty:
+            if block and not all(p.is_alive() for p in self.processes):
+                raise RuntimeError('A processing worker died')
+            return
+        self.done[frame_number] = slot
+
+    def get(self):
+        # next result in order, its slot stays valid until the following get
+        if self.held is not None:
+            self.free.append(self.held)
+            self.held = None
+        if self.pending() == 0:
+            return None
+        while self.delivered not in self.done:
+            self.collect(block=True)
+        slot = self.done.pop(self.delivered)
+        self.delivered += 1
+        self.held = slot
+        res_h, res_w = Calibration.crop_shape(self.rois.pop(self.delivered - 1), self.conf.sampling_reduction)
+        result_img = self.frames.result_img[slot, 0:res_h, 0:res_w]
+        result_depth_3d = np.broadcast_to(self.frames.result_depth[slot, 0:res_h, 0:res_w, np.newaxis],
+                                          result_img.shape)
+        return self.delivered - 1, self.frames.depth[slot], result_img, result_depth_3d
+
+    def drain(self):
+        while self.get() is not None:
+            pass
@@ -1,6 +1,42 @@
 import numpy as np
 import cv2
 
+import Calibration
+import Dtypes
+
+def separate(depth, color, bg, min_distance, brightness, out_color, out_depth):
+    # fused background separation, one pass over the frame
+    for y in range(depth.shape[0]):
+        for x in range(depth.shape[1]):
+            d = depth[y, x]
+            if d < bg[y, x]:
+                out_depth[y, x] = d
+                if d > min_distance:
+                    for c in range(3):
+                        v = color[y, x, c]
+                        out_color[y, x, c] = v if v > brightness else 0
+                    continue
+            else:
+                out_depth[y, x] = 0
+            out_color[y, x, 0] = 0
+            out_color[y, x, 1] = 0
+            out_color[y, x, 2] = 0
+
+
+compiled = None
+
+
+def separate_kernel():
+    # numba is imported and the kernel compiled (or loaded from its cache) on first use, None without numba
+    global compiled
+    if compiled is None:
+        try:
+            import numba
+            compiled = numba.njit(cache=True, nogil=True)(separate)
+        except ImportError:
+            compiled = False
+    return compiled or None
+
 
 class Processors:
     h, w = (480, 640)
@@ -12,20 +48,110 @@ class Processors:
         self.clipping_tolerance = conf.clipping_tolerance
         self.brightness_level = conf.brightness_limit
         self.min_distance = conf.min_distance
+        self.use_numba = conf.use_numba
+        self.kernel = None
+        self.roi = Calibration.full_roi(self.h, self.w)
+
+        # output buffers, reused across frames
+        self.result_img = None
+        self.result_depth = None
+        self.mask = None
+        self.near = None
+        self.bright = None
+
+    def set_roi(self, roi):
+        self.roi = roi
+
+    def reduce(self, image):
+        # crop to the region of interest and apply the sampling reduction
+        return Calibration.crop(image, self.roi, self.compression)
 
     def generate_background(self, depth_frame):
-        result_img = \
-            np.asanyarray(depth_frame.get_data())[0:self.h:self.compression, 0:self.w:self.compression] - \
-            self.clipping_tolerance
-        print(result_img.shape)
-        result_img = cv2.erode(result_img, np.ones((self.kernel_size, self.kernel_size), np.uint8),
-                               iterations=self.iter)
-        return np.dstack((result_img, result_img, result_img))
-
-    def process(self, depth_frame, color_frame, bg_image_3d):
+        return self.generate_background_from_image(np.asanyarray(depth_frame.get_data()))
+
+    def generate_background_from_image(self, depth_image):
+        Dtypes.check('depth_image', depth_image, Dtypes.depth)
+        # saturated, pixels closer than clipping_tolerance are 0 instead of wrapping to far away
+        result_img = Dtypes.subtract(self.reduce(depth_image), self.clipping_tolerance)
+        # single channel, process broadcasts it against the colour image
+        return cv2.erode(result_img, np.ones((self.kernel_size, self.kernel_size), np.uint8),
+                         iterations=self.iter)
+
+    def process(self, depth_frame, color_frame, bg_image):
         # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())[0:self.h:self.compression, 0:self.w:self.compression]
-        color_image = np.asanyarray(color_frame.get_data())[0:self.h:self.compression, 0:self.w:self.compression, :]
+        return self.process_images(np.asanyarray(depth_frame.get_data()), np.asanyarray(color_frame.get_data()),
+                                   bg_image)
+
+    def allocate(self, shape):
+        # True if the buffers are new and hold no results yet
+        if self.result_img is None or self.result_img.shape[0:2] != shape:
+            self.result_img = np.zeros(shape + (3,), Dtypes.color)
+            self.result_depth = np.zeros(shape, Dtypes.depth)
+            self.mask = np.zeros(shape, bool)
+            self.near = np.zeros(shape, bool)
+            self.bright = np.zeros(shape + (3,), bool)
+            return True
+        return False
+
+    def set_output(self, result_img, result_depth):
+        # let process_images write into caller owned buffers, e.g. shared memory
+        self.allocate(result_depth.shape)
+        self.result_img = result_img
+        self.result_depth = result_depth
+
+    def process_images(self, depth_image, color_image, bg_image, tiles=None):
+        # results are written into buffers owned by Processors and are only valid until the next call.
+        # tiles is a list of (y0, y1, x0, x1) regions to update, the rest keeps the previous result
+        Dtypes.check('depth_image', depth_image, Dtypes.depth)
+        Dtypes.check('color_image', color_image, Dtypes.color)
+        Dtypes.check('bg_image', bg_image, Dtypes.depth)
+        depth_image = self.reduce(depth_image)
+        color_image = self.reduce(color_image)
+        if self.allocate(depth_image.shape):
+            tiles = None
+
+        if self.use_numba and self.kernel is None:
+            self.kernel = separate_kernel()
+            self.use_numba = self.kernel is not None
+
+        if tiles is None:
+            self.separate(depth_image, color_image, bg_image, (slice(None), slice(None)))
+        else:
+            for y0, y1, x0, x1 in tiles:
+                self.separate(depth_image, color_image, bg_image, (slice(y0, y1), slice(x0, x1)))
+
+        # three channel view for the callers, no copy
+        return self.result_img, np.broadcast_to(self.result_depth[:, :, np.newaxis], self.result_img.shape)
+
+    def separate(self, depth_image, color_image, bg_image, region):
+        depth_image, color_image, bg_image = depth_image[region], color_image[region], bg_image[region]
+        result_img, result_depth = self.result_img[region], self.result_depth[region]
+        if self.use_numba:
+            self.kernel(depth_image, color_image, bg_image, self.min_distance, self.brightness_level,
+                        result_img, result_depth)
+            return
+
+        mask, near, bright = self.mask[region], self.near[region], self.bright[region]
+        # Background Separation
+        np.less(depth_image, bg_image, out=mask)
+        result_depth.fill(0)
+        np.copyto(result_depth, depth_image, where=mask)
+
+        # Minimum Distance
+        np.greater(depth_image, self.min_distance, out=near)
+        np.logical_and(mask, near, out=mask)
+
+        # Only the brightest channels survive
+        np.greater(color_image, self.brightness_level, out=bright)
+        np.logical_and(bright, mask[:, :, np.newaxis], out=bright)
+        result_img.fill(0)
+        np.copyto(result_img, color_image, where=bright)
+
+    def process_images_reference(self, depth_image, color_image, bg_image):
+        # original unfused implementation, kept to check process_images against
+        depth_image = self.reduce(depth_image)
+        color_image = self.reduce(color_image)
+        bg_image_3d = np.dstack((bg_image, bg_image, bg_image))
 
         # Background Separation
         depth_image_3d = np.dstack((depth_image, depth_image, depth_image))
@@ -40,10 +166,55 @@ class Processors:
 
         return result_img, result_depth_3d
 
+    @staticmethod
+    def grey(color_image, out=None):
+        return cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY, dst=out)
+
+    def grey_burst(self, cam, frames):
+        # consecutive frames as one uint8 stack [frames, h, w]
+        color_image = cam.get_next_images()[1]
+        stack = np.empty((frames,) + color_image.shape[0:2], np.uint8)
+        self.grey(color_image, stack[0])
+        for i in range(1, frames):
+            self.grey(cam.get_next_images()[1], stack[i])
+        return stack
+
+    @staticmethod
+    def blob_masks(stack, conf, background_image):
+        # bright pixels that differ from the background, for every frame of the stack
+        diff = np.abs(stack.astype(np.int16) - background_image) > conf.calib_separation_limit * 255
+        return diff & (stack > conf.calib_brightness_limit * 255)
+
+    def dot_visible(self, color_image, conf, background_image):
+        mask = self.blob_masks(self.grey(color_image)[np.newaxis], conf, background_image)
+        return np.count_nonzero(mask) >= conf.calib_min_pixels
+
+    def blob_burst(self, cam, conf, background_image):
+        return self.burst_centroid(self.grey_burst(cam, conf.calib_burst), conf, background_image)
+
+    def burst_centroid(self, stack, conf, background_image):
+        # median centroid over a burst of frames, frames far from the median are rejected
+        masks = self.blob_masks(stack, conf, background_image)
+        count = masks.sum(axis=(1, 2))
+        ys = masks.sum(axis=2) @ np.arange(masks.shape[1])
+        xs = masks.sum(axis=1) @ np.arange(masks.shape[2])
+        seen = count >= conf.calib_min_pixels
+        if not seen.any():
+            return None, None, stack[-1], masks[-1]
+
+        centroids = np.stack((xs[seen] / count[seen], ys[seen] / count[seen]), axis=1)
+        median = np.median(centroids, axis=0)
+        dev = np.linalg.norm(centroids - median, axis=1)
+        keep = dev <= max(3 * np.median(dev), 1.0)
+        x, y = np.median(centroids[keep], axis=0)
+        return float(x), float(y), stack[-1], masks[-1]
+
     def blob_detection(self, cam, conf, background_image):
-        color_image = np.sum(cam.get_color_image(), axis=2) / 3 / 255
-        diff_img = np.where(np.abs(color_image - background_image) > conf.calib_separation_limit, color_image, 0)
-        index = np.where(diff_img > conf.calib_brightness_limit)
+        # background_image is grey as well, the limits are fractions of 255
+        color_image = self.grey(cam.get_color_image())
+        diff = cv2.absdiff(color_image, Dtypes.check('background_image', background_image, Dtypes.grey))
+        diff_img = np.where(diff > conf.calib_separation_limit * 255, color_image, 0)
+        index = np.where(diff_img > conf.calib_brightness_limit * 255)
         y = int(np.sum(index[0] / index[0].shape[0]))
         x = int(np.sum(index[1] / index[1].shape[0]))
         return x, y, color_image, diff_img
@@ -0,0 +1,67 @@
+import os
+import threading
+import numpy as np
+
+
+class Recorder:
+    # writes frames to compressed npz chunks: depth uint16, color uint8, frame_number, timestamp [ms].
+    # two chunk buffers: one is filled while the other is compressed on a writer thread. a chunk holds
+    # record_chunk_mb of raw frames, the second buffer is only allocated once the first is flushed.
+
+    def __init__(self, conf):
+        self.path = conf.record_path
+        self.img_h, self.img_w = conf.img_h, conf.img_w
+        frame_bytes = self.img_h * self.img_w * (np.dtype(np.uint16).itemsize + 3 * np.dtype(np.uint8).itemsize)
+        self.chunk_size = max(1, int(conf.record_chunk_mb * 2 ** 20) // frame_bytes)
+        self.buffers = [self.allocate(self.img_h, self.img_w), None]
+        self.active = 0
+        self.writer = None
+        self.count = 0
+        self.chunk_index = 0
+        self.frames = 0
+
+    def allocate(self, img_h, img_w):
+        return {'depth': np.zeros((self.chunk_size, img_h, img_w), np.uint16),
+                'color': np.zeros((self.chunk_size, img_h, img_w, 3), np.uint8),
+                'frame_number': np.zeros(self.chunk_size, np.int64),
+                'timestamp': np.zeros(self.chunk_size)}
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.count = 0
+        self.chunk_index = 0
+        self.frames = 0
+
+    def add(self, depth_image, color_image, frame_number, timestamp):
+        chunk = self.buffers[self.active]
+        chunk['depth'][self.count] = depth_image
+        chunk['color'][self.count] = color_image
+        chunk['frame_number'][self.count] = frame_number
+        chunk['timestamp'][self.count] = timestamp
+        self.count += 1
+        self.frames += 1
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        self.wait()
+        outfile = os.path.join(self.path, 'chunk_' + str(self.chunk_index).zfill(5) + '.npz')
+        chunk = {key: data[0:self.count] for key, data in self.buffers[self.active].items()}
+        self.writer = threading.Thread(target=np.savez_compressed, args=(outfile,), kwargs=chunk)
+        self.writer.start()
+        self.active = 1 - self.active
+        if self.buffers[self.active] is None:
+            self.buffers[self.active] = self.allocate(self.img_h, self.img_w)
+        self.chunk_index += 1
+        self.count = 0
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def stop(self):
+        self.flush()
+        self.wait()
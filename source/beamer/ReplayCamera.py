@@ -0,0 +1,90 @@
+import glob
+import os
+import time
+import numpy as np
+
+import CameraBase
+
+
+class ReplayCamera(CameraBase.CameraBase):
+    # plays back a session written by Recorder, no hardware needed
+
+    def __init__(self, conf, tick):
+        super().__init__(conf, tick)
+        self.path = conf.replay_path
+        self.realtime = conf.replay_realtime
+        self.loop = conf.replay_loop
+        self.preload = conf.replay_preload
+        self.files = []
+        self.chunks = {}
+        self.chunk = None
+        self.chunk_index = 0
+        self.frame_index = 0
+        self.played = 0
+        self.last_timestamp = None
+        self.last_time = None
+
+    def open(self):
+        self.files = sorted(glob.glob(os.path.join(self.path, 'chunk_*.npz')))
+        if len(self.files) == 0:
+            print('Error: No recording found in ' + self.path)
+            return False
+        if self.preload:
+            self.chunks = {i: self.load_chunk(i) for i in range(0, len(self.files))}
+        self.rewind()
+        return True
+
+    def close(self):
+        self.chunks = {}
+        self.chunk = None
+
+    def rewind(self):
+        self.chunk_index = 0
+        self.frame_index = 0
+        self.chunk = self.get_chunk(0)
+        self.last_timestamp = None
+        self.last_time = None
+
+    def load_chunk(self, i):
+        with np.load(self.files[i]) as data:
+            return {key: data[key] for key in ('depth', 'color', 'frame_number', 'timestamp')}
+
+    def get_chunk(self, i):
+        if i in self.chunks:
+            return self.chunks[i]
+        return self.load_chunk(i)
+
+    def grab(self):
+        with self.tick.stage('acquire'):
+            return self.next_frame()
+
+    def next_frame(self):
+        if self.frame_index >= self.chunk['depth'].shape[0]:
+            self.chunk_index += 1
+            if self.chunk_index >= len(self.files):
+                if not self.loop:
+                    raise EOFError('End of recording ' + self.path)
+                self.rewind()
+            else:
+                self.frame_index = 0
+                self.chunk = self.get_chunk(self.chunk_index)
+
+        i = self.frame_index
+        self.frame_index += 1
+        timestamp = float(self.chunk['timestamp'][i])
+        if self.realtime:
+            self.pace(timestamp)
+
+        self.played += 1
+        return self.chunk['depth'][i], self.chunk['color'][i], self.played, timestamp
+
+    def pace(self, timestamp):
+        # keep the recorded frame spacing, timestamps are in ms
+        now = time.perf_counter()
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            delay = (timestamp - self.last_timestamp) / 1000 - (now - self.last_time)
+            if delay > 0:
+                time.sleep(delay)
+                now = time.perf_counter()
+        self.last_timestamp = timestamp
+        self.last_time = now
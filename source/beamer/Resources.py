@@ -0,0 +1,149 @@
+import threading
+
+
+class Resources:
+    # creates the per state objects on first use. heavy modules (cv2, numba, pyrealsense2)
+    # are only imported by the factories, the camera and its calibration tables can be
+    # warmed up on a background thread while the menu is shown.
+
+    def __init__(self, conf, tick):
+        self.conf = conf
+        self.tick = tick
+        self.startup = tick.startup
+        self.factories = {'disp': self.make_disp, 'cams': self.make_cams, 'proc': self.make_proc,
+                          'rec': self.make_rec, 'touch': self.make_touch, 'dataset': self.make_dataset,
+                          'bgm': self.make_bgm, 'pool': self.make_pool, 'classifier': self.make_classifier,
+                          'changes': self.make_changes, 'stream': self.make_stream}
+        self.objects = {}
+        # name -> exception of the last failed creation, cleared once it succeeds
+        self.failed = {}
+        self.locks = {name: threading.Lock() for name in self.factories}
+        self.warm_thread = None
+
+    def get(self, name):
+        # blocks while a background warmup is creating the same object
+        with self.locks[name]:
+            if name not in self.objects:
+                with self.startup.phase(name):
+                    try:
+                        self.objects[name] = self.factories[name]()
+                    except Exception as e:
+                        self.failed[name] = e
+                        raise
+                self.failed.pop(name, None)
+            return self.objects[name]
+
+    def ready(self, name):
+        return name in self.objects
+
+    def warm(self, *names):
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    # recorded in failed, created again on first use
+                    print('Error: Loading ' + name + ' failed: ' + repr(e))
+        self.warm_thread = threading.Thread(target=run, name='warmup', daemon=True)
+        self.warm_thread.start()
+
+    def calibration_status(self):
+        # None while the cameras and their calibration are still loading, False if loading failed
+        if not self.ready('cams'):
+            return False if 'cams' in self.failed else None
+        return all(cam.calib_done for cam in self.objects['cams'])
+
+    def cameras(self):
+        # all cameras, opened on first use. the ones that failed to open are left out
+        cams = self.get('cams')
+        for cam in cams:
+            if not cam.status:
+                with self.startup.phase('camera start'):
+                    cam.start()
+        return [cam for cam in cams if cam.status]
+
+    def camera(self):
+        # the first camera, False if it is not available
+        try:
+            cam = self.get('cams')[0]
+        except Exception as e:
+            print('Error: No camera: ' + repr(e))
+            return False
+        if not cam.status:
+            self.cameras()
+        return cam if cam.status else False
+
+    def make_disp(self):
+        import Display
+        disp = Display.Display(self.conf)
+        disp.start()
+        return disp
+
+    def make_cams(self):
+        import MultiCamera
+        cams = []
+        for conf in MultiCamera.camera_confs(self.conf):
+            if conf.camera_backend == 'replay':
+                import ReplayCamera
+                cams.append(ReplayCamera.ReplayCamera(conf, self.tick))
+            else:
+                import Camera
+                cams.append(Camera.Camera(conf, self.tick))
+        return cams
+
+    def make_stream(self):
+        if not self.conf.stream_port:
+            return None
+        import Streamer
+        stream = Streamer.Streamer(self.conf, self.tick, self.get('disp'))
+        stream.start()
+        return stream
+
+    def make_proc(self):
+        import Processors
+        return Processors.Processors(self.conf)
+
+    def make_rec(self):
+        import Recorder
+        return Recorder.Recorder(self.conf)
+
+    def make_touch(self):
+        import TouchDetector
+        return TouchDetector.TouchDetector(self.conf)
+
+    def make_dataset(self):
+        import Dataset
+        return Dataset.DatasetWriter(self.conf)
+
+    def make_classifier(self):
+        import Classifier
+        return Classifier.Classifier(self.conf)
+
+    def make_bgm(self):
+        if not self.conf.bg_adaptive:
+            return None
+        import Background
+        return Background.Background(self.conf)
+
+    def make_changes(self):
+        if not self.conf.use_changes:
+            return None
+        import ChangeDetector
+        return ChangeDetector.ChangeDetector(self.conf)
+
+    def make_pool(self):
+        if self.conf.pool_workers == 0:
+            return None
+        import ProcessingPool
+        pool = ProcessingPool.ProcessingPool(self.conf)
+        pool.start()
+        return pool
+
+    def stop(self):
+        if self.warm_thread is not None:
+            self.warm_thread.join()
+        for cam in self.objects.get('cams', []):
+            cam.stop()
+        for name in ('stream', 'disp', 'pool'):
+            if self.objects.get(name) is not None:
+                self.objects[name].stop()
@@ -0,0 +1,134 @@
+import heapq
+import itertools
+import time
+
+
+class State:
+    # base of the state handlers. a handler returns the next state id from any of its
+    # callbacks, None stays in the state. frames is None (no camera frames), 'latest' (newest
+    # frame, older ones are dropped) or 'next' (every frame in order).
+    frames = None
+    needs_camera = True
+
+    def enter(self):
+        return None
+
+    def exit(self):
+        pass
+
+    def wait_frame(self, cam, timeout):
+        # the frame passed to on_frame, None on timeout
+        return cam.wait_frame(self.frames == 'latest', timeout)
+
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        return None
+
+    def on_key(self, key):
+        return None
+
+    def on_timer(self, name):
+        return None
+
+
+class Scheduler:
+    # drives the registered states by key, frame and timer events. the thread blocks in
+    # the camera ring buffer or in the window event loop until the next event is due,
+    # nothing is polled in between.
+
+    frame_timeout = 0.5
+    idle_timeout = 1.0
+
+    def __init__(self, res, tick):
+        self.res = res
+        self.tick = tick
+        self.states = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        self.state_id = None
+        self.state = None
+        self.stream = None
+
+    def register(self, state_id, state):
+        self.states[state_id] = state
+
+    def call_later(self, seconds, name):
+        # timer event for the current state, dropped on a state change
+        heapq.heappush(self.timers, (time.perf_counter() + seconds, next(self.sequence), name))
+
+    def cancel(self, name):
+        self.timers = [t for t in self.timers if t[2] != name]
+        heapq.heapify(self.timers)
+
+    def next_timer(self):
+        return self.timers[0][0] - time.perf_counter() if self.timers else None
+
+    def switch(self, state_id):
+        # leave the current state and enter state_id, entering may redirect again
+        while state_id is not None:
+            if self.state is not None:
+                self.guard(self.state.exit)
+            self.timers = []
+            self.state = None
+            self.state_id = state_id
+            if state_id == -1:
+                return
+            state = self.states[state_id]
+            if state.needs_camera and not self.res.camera():
+                # no camera, back to the menu
+                state_id = 0
+                continue
+            self.state = state
+            if self.stream is not None:
+                self.stream.event('state', {'state': state_id, 'name': type(state).__name__})
+            state_id = self.guard(state.enter)
+
+    def guard(self, callback, *args):
+        # a failing state ends in the menu, the end of a replay too
+        try:
+            return callback(*args)
+        except EOFError:
+            print('Camera stream ended')
+        except Exception as e:
+            print('An error occurred in state ' + str(self.state_id) + ': ' + repr(e))
+        return 0 if self.state_id != 0 else -1
+
+    def run(self, state_id):
+        disp = self.res.get('disp')
+        self.stream = stream = self.res.get('stream')
+        self.switch(state_id)
+        while self.state is not None:
+            state = self.state
+            due = self.next_timer()
+
+            if due is not None and due <= 0:
+                deadline, seq, name = heapq.heappop(self.timers)
+                self.switch(self.guard(state.on_timer, name))
+                continue
+
+            if state.frames is not None:
+                # frame paced, the window is serviced once per frame
+                timeout = self.frame_timeout if due is None else min(due, self.frame_timeout)
+                frame = self.guard(state.wait_frame, self.res.camera(), timeout)
+                if isinstance(frame, int):
+                    self.switch(frame)
+                    continue
+                if frame is not None:
+                    next_state = self.guard(state.on_frame, *frame)
+                    if next_state is not None:
+                        self.switch(next_state)
+                        continue
+                with self.tick.stage('show'):
+                    key = disp.show()
+                    if stream is not None:
+                        stream.publish(disp.insitu_img)
+                if frame is not None:
+                    self.tick.frame()
+            else:
+                # idle, blocks in the window event loop until a key or the next timer
+                timeout = self.idle_timeout if due is None else min(due, self.idle_timeout)
+                key = disp.show(max(1, int(timeout * 1000)))
+                if stream is not None:
+                    stream.publish(disp.insitu_img)
+
+            if key != -1:
+                self.switch(self.guard(state.on_key, key & 0xFF))
@@ -1,185 +1,466 @@
+import os
 import numpy as np
-import time
 import random as rnd
 
+from Scheduler import State
 
-class States:
 
-    # State 0 - Main Menu
-    def main_menu(self, disp, cam):
-        # static video content
-        disp.clear()
-        disp.add_static_text('1: Run', 50, 100, (0, 200, 0), 1)
-        disp.add_static_text('2: Calibration', 50, 150, (0, 200, 0), 1)
-        if cam.calib_done:
-            disp.add_static_text('(data available)', 300, 150, (200, 0, 0), 1)
-        else:
-            disp.add_static_text('(no calib data)', 300, 150, (0, 0, 200), 1)
-        disp.add_static_text('3: Training', 50, 200, (0, 200, 0), 1)
-        disp.add_static_text('4: Livestream', 50, 250, (0, 200, 0), 1)
-        disp.add_static_text('0: Exit', 50, 350, (0, 200, 0), 1)
-
-        while True:
-            key = disp.show()
-            if key == 27:
-                return -1
-            if key == ord('0'):
-                return -1
-            if key == ord('1'):
-                return 1
-            if key == ord('2'):
-                return 2
-            if key == ord('3'):
-                return 3
-            if key == ord('4'):
-                return 4
-            if key == -1:
-                continue
-
-    # State 1 - Processing [aka Run]
-    def processing(self, disp, cam, proc, tick, conf):
+class StateBase(State):
+    # handlers get their resources from res when they are entered
+
+    def __init__(self, sched, res, conf, tick):
+        self.sched = sched
+        self.res = res
+        self.conf = conf
+        self.tick = tick
+        self.disp = None
+        self.cam = None
+        self.stream = None
+
+    def enter(self):
+        self.disp = self.res.get('disp')
+        self.stream = self.res.get('stream')
+        self.cam = self.res.camera()
+        return self.start()
+
+    def start(self):
+        return None
+
+    def notify(self, kind, data):
+        # event for remote monitoring, dropped without a stream server
+        if self.stream is not None:
+            self.stream.event(kind, data)
+
+    def on_key(self, key):
+        # escape leaves every state to the menu
+        if key == 27:
+            return 0
+        return None
+
+
+# State 0 - Main Menu
+class MainMenu(StateBase):
+    needs_camera = False
+    calib_labels = {None: ('(loading calib data)', (200, 200, 200)),
+                    True: ('(data available)', (200, 0, 0)),
+                    False: ('(no calib data)', (0, 0, 200))}
+    keys = {ord('0'): -1, ord('1'): 1, ord('2'): 2, ord('3'): 3, ord('4'): 4, ord('5'): 5}
+
+    def enter(self):
+        self.disp = self.res.get('disp')
+        self.shown = 'none'
+        self.draw()
+
+    def draw(self):
+        # calibration data may still be loading in the background, the menu is redrawn once it is
+        status = self.res.calibration_status()
+        if status != self.shown:
+            # static video content
+            disp = self.disp
+            disp.clear()
+            disp.add_static_text('1: Run', 50, 100, (0, 200, 0), 1)
+            disp.add_static_text('2: Calibration', 50, 150, (0, 200, 0), 1)
+            disp.add_static_text(self.calib_labels[status][0], 300, 150, self.calib_labels[status][1], 1)
+            disp.add_static_text('3: Training', 50, 200, (0, 200, 0), 1)
+            disp.add_static_text('4: Livestream', 50, 250, (0, 200, 0), 1)
+            disp.add_static_text('5: Record', 50, 300, (0, 200, 0), 1)
+            disp.add_static_text('0: Exit', 50, 350, (0, 200, 0), 1)
+            self.shown = status
+        if status is None:
+            self.sched.call_later(0.2, 'calib')
+
+    def on_timer(self, name):
+        self.draw()
+
+    def on_key(self, key):
+        if key == 27:
+            return -1
+        return self.keys.get(key)
+
+
+# State 1 - Processing [aka Run]
+class Processing(StateBase):
+    frames = 'latest'
+    buttons = (('red', 420, 70, 60, (0, 0, 200)),
+               ('green', 570, 70, 60, (0, 200, 0)),
+               ('blue', 720, 70, 60, (200, 0, 0)))
+
+    def start(self):
+        disp, res = self.disp, self.res
+        self.proc = res.get('proc')
+        self.touch = res.get('touch')
+        self.bgm = res.get('bgm')
+        self.pool = res.get('pool')
+        self.classifier = res.get('classifier')
+        # the pool processes whole frames
+        self.changes = res.get('changes') if self.pool is None else None
+        self.add_buttons()
+
+        # every per frame stage works on the projector footprint only
+        roi = self.cam.roi
+        for stage in (self.proc, disp, self.touch, self.bgm, self.pool, self.classifier, self.changes):
+            if stage is not None:
+                stage.set_roi(roi)
+        if self.changes is not None:
+            self.changes.reset()
+
+        # flag for background
+        self.do_bg = True
+        self.background_img = None
+
+        self.tick.reset()
+        self.touch.reset()
+        self.gesture = ''
+
+    def add_buttons(self):
         # static video content
+        conf, disp = self.conf, self.disp
         disp.clear()
         disp.add_border(0, 0, int(2 * conf.vid_w / conf.sampling_reduction), int(conf.vid_h / conf.sampling_reduction))
-        disp.add_button(420, 70, 60, (0, 0, 200))
-        disp.add_button(570, 70, 60, (0, 200, 0))
-        disp.add_button(720, 70, 60, (200, 0, 0))
+        self.touch.clear_buttons()
+        for name, cx, cy, r, col in self.buttons:
+            disp.add_button(cx, cy, r, col)
+            self.touch.add_button(name, cx, cy, r)
+        self.colors = {name: col for name, cx, cy, r, col in self.buttons}
 
-        # flag for background
-        do_bg = True
+    def draw_events(self, events):
+        # pressed buttons are drawn brighter
+        touch = self.touch
+        for name, event, vid_x, vid_y in events:
+            self.notify('touch', {'button': name, 'event': event, 'x': vid_x, 'y': vid_y})
+            i = touch.buttons.index(name)
+            col = self.colors[name] if event == 'release' else tuple(min(255, c + 55) for c in self.colors[name])
+            self.disp.add_button(int(touch.centers[i, 0]), int(touch.centers[i, 1]), int(touch.radii[i]), col)
 
-        try:
-            while True:
-                # timer start for fps
-                tick.tick(0)
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        tick, proc, touch, bgm, pool, disp = self.tick, self.proc, self.touch, self.bgm, self.pool, self.disp
 
-                # get frames
-                depth_frame, color_frame = cam.get_frames()
+        # Generate Background if not yet set, then keep the adaptive model up to date
+        with tick.stage('background'):
+            if self.do_bg:
+                if bgm is None:
+                    self.background_img = proc.generate_background_from_image(depth_image)
+                else:
+                    self.background_img = bgm.reset(depth_image)
+                changed = True
+                self.do_bg = False
+            else:
+                changed = bgm is not None and bgm.update(depth_image)
+            if changed and pool is not None:
+                pool.set_background(self.background_img)
+        background_img = self.background_img
 
-                # get timer for fps
-                tick.tick(1)
+        # do processing, without the pool only on the tiles that changed since the last frame
+        tiles = None
+        with tick.stage('process'):
+            if pool is None:
+                if self.changes is not None:
+                    tiles = self.changes.update(depth_image, self.changes.active(proc.result_depth))
+                    if tiles is not None:
+                        tiles = self.changes.rects(tiles)
+                        if changed:
+                            tiles = None if bgm is None or bgm.dirty is None else tiles + bgm.dirty
+                result_img, result_depth_3d = proc.process_images(depth_image, color_image, background_img, tiles)
+            else:
+                # results come back in order, pool_workers frames behind
+                pool.submit(depth_image, color_image)
+                if pool.pending() < self.conf.pool_workers:
+                    return None
+                frame_number, depth_image, result_img, result_depth_3d = pool.get()
 
-                # Generate Background if not yet set
-                if do_bg:
-                    background_img = proc.generate_background(depth_frame)
-                    do_bg = False
+        # touch events on the buttons, the blobs of the last frame are still valid on a quiet frame
+        with tick.stage('touch'):
+            if tiles is not None and len(tiles) == 0:
+                self.draw_events(touch.hit(touch.points))
+            else:
+                self.draw_events(touch.update(result_depth_3d[:, :, 0], background_img, self.cam))
 
-                # do processing
-                result_img, result_depth_3d = proc.process(depth_frame, color_frame, background_img)
-                depth_colormap = disp.color_depth_from_frame(depth_frame)
+        # classified gestures on the buttons
+        if self.classifier is not None:
+            with tick.stage('classify'):
+                for name, label, vid_x, vid_y in self.classifier.update(result_depth_3d[:, :, 0], touch):
+                    self.gesture = name + ': ' + (label if label is not None else '-')
+                    self.notify('gesture', {'button': name, 'label': label, 'x': vid_x, 'y': vid_y})
+        with tick.stage('colormap'):
+            depth_colormap = disp.color_depth_reduced(depth_image, tiles)
 
-                # proc timer for fps
-                tick.tick(2)
+        # prepare videoframe
+        with tick.stage('compose'):
+            disp.update_streams(depth_colormap, result_img)
+            disp.update_info(tick.get_info() + ['ring dropped: ' + str(self.cam.dropped_frames), self.gesture])
+        return None
 
-                # prepare videoframe
-                disp.update_streams(depth_colormap, result_img)
-                disp.update_info(tick.get_info())
+    def exit(self):
+        if self.pool is not None:
+            self.pool.drain()
 
-                if disp.show() == 27:
-                    break
 
-                # update timer and fps
-                tick.tick(3)
-                tick.update_info()
+class MultiProcessing(Processing):
+    # several cameras, each processed on its own worker, touches fused in the shared projector space.
+    # streams of the first camera are shown
 
-        except:
-            print('An error occurred in processing')
-            return -1
+    def start(self):
+        self.touch = self.res.get('touch')
+        self.add_buttons()
+        self.disp.set_roi(self.cam.roi)
+        import MultiCamera
+        self.group = MultiCamera.CameraGroup(self.conf, self.res.cameras())
+        self.group.start()
+        self.tick.reset()
+        self.touch.reset()
+
+    def wait_frame(self, cam, timeout):
+        frame = self.group.wait_frame(timeout)
+        return None if frame is None else (frame,)
+
+    def on_frame(self, fused):
+        points, result_img, depth_image, frame_number, timestamp = fused
+        tick, disp = self.tick, self.disp
+
+        # touch events on the buttons
+        with tick.stage('touch'):
+            self.draw_events(self.touch.hit(points))
+        with tick.stage('colormap'):
+            depth_colormap = disp.color_depth_from_image(depth_image)
+
+        # prepare videoframe
+        with tick.stage('compose'):
+            disp.update_streams(depth_colormap, result_img)
+            disp.update_info(tick.get_info() + ['cameras: ' + str(len(self.group.workers)) +
+                                                '  touches: ' + str(len(points))])
+        return None
+
+    def exit(self):
+        self.group.stop()
 
-        finally:
-            return 0
 
-    # State 2 - Calibration [fullres, no compression considered]
-    def calibration(self, disp, cam, proc, conf):
+# State 2 - Calibration [fullres, no compression considered]
+class Calibrating(StateBase):
+    # per dot: wait until the camera no longer sees the previous dot, show the dot, wait until
+    # it is seen and locate it in a burst of frames. waits end on calib_timeout.
+    # several cameras are calibrated one after the other, each to its area of the projector space
+    frames = 'next'
+
+    def start(self):
+        self.proc = self.res.get('proc')
+        self.cams = self.res.cameras()
+        self.cam_index = -1
+        return self.next_camera()
+
+    def next_camera(self):
+        self.cam_index += 1
+        if self.cam_index == len(self.cams):
+            return 0
+        self.cam = self.cams[self.cam_index]
         # reset lookup table
-        cam.reset_lookup_table()
-        # background
-        disp.clear()
-        disp.show()
-        time.sleep(conf.sleeptime)
-        background_image = np.sum(cam.get_color_image(), axis=2) / 3 / 255
-
-        # display and evaluate dot images
-        for i in range(0, 3):
-            for j in range(0, 3):
-                disp.clear()
-                vid_x = i * 350 + 25
-                vid_y = j * 175 + 25
-                disp.add_button(vid_x, vid_y, 20, (255, 255, 255))
-                disp.show()
-                time.sleep(conf.sleeptime)
-                cam_x, cam_y, img, diff = proc.blob_detection(cam, conf, background_image)
-
-                if conf.DEBUG:
-                    outfile = str(vid_x) + '_' + str(vid_y) + '.csv'
-                    np.savetxt(conf.DEBUG_PATH + outfile, img)
-                    np.savetxt(conf.DEBUG_PATH + 'diff-' + outfile, diff)
-                    np.savetxt(conf.DEBUG_PATH + 'background.csv', background_image)
-
-                cam.set_lookup_point(vid_x, vid_y, cam_x, cam_y)
-
-        cam.do_lookup_table()
-        cam.write_lookup_table()
-
-        #y_test, x_test = cam.query_lookup_table(375, 200)
-        #print(x_test, y_test)
-
-        return 0
-
-    # State 3 - Training
-    def training(self, disp, proc, cam, conf):
-        # background
-        disp.clear()
-        disp.show()
-        depth_frame, color_frame = cam.get_frames()
-        background_img = proc.generate_background(depth_frame)
+        self.cam.reset_lookup_table()
+        import Calibration
+        self.points = Calibration.grid_points(self.cam.conf)
+        self.offset = self.cam.conf.vid_offset
+        self.index = -1
+        self.stack = []
+        self.background_image = None
+        # background after the projector settled
+        self.disp.clear()
+        self.phase = 'settle'
+        self.wait = self.conf.settle_frames
+        return None
 
-        counter = 0
-        while counter < conf.train_loops:
-            #blank
-            disp.clear()
-            disp.add_static_text(str(counter), 50, 100, (0, 200, 0), 1)
-            disp.show()
-            time.sleep(conf.sleeptime)
-            #blob
-            vid_x = rnd.randrange(100, conf.vid_w - 100)
-            vid_y = rnd.randrange(100, conf.vid_h - 100)
-            cam_pts = cam.query_lookup_table(vid_x, vid_y)
-            # consider compression
-            cam_x = int(cam_pts[1] / conf.sampling_reduction)
-            cam_y = int(cam_pts[0] / conf.sampling_reduction)
-            disp.add_button(vid_x, vid_y, 60, (0, 0, 200))
-            disp.show()
-            time.sleep(conf.sleeptime)
-            #record
-            framecounter = 0
-            result = np.zeros(shape=(2 * conf.train_region * conf.train_frames, 2 * conf.train_region))
-            while framecounter < conf.train_frames:
-                depth_frame, color_frame = cam.get_frames()
-                # get result images, where compression is applied and background is separated
-                result_img, result_depth_3d = proc.process(depth_frame, color_frame, background_img)
-                result[2 * conf.train_region * framecounter:2 * conf.train_region * (framecounter+1), :] = result_depth_3d[cam_y-conf.train_region:cam_y+conf.train_region, cam_x-conf.train_region:cam_x+conf.train_region, 0]
-                framecounter = framecounter + 1
-            # write to file
-            outfile = conf.TRAIN_PATH + str(counter) + '.csv'
-            np.savetxt(outfile, result, delimiter=';')
-            counter += 1
-        return 0
-
-    # State 4 - Live Stream
-    def livestream(self, disp, cam, proc):
-        try:
-            disp.clear()
-            while True:
-                # get images
-                depth_image, color_image = cam.get_images()
-                depth_colormap = disp.color_depth_from_image(depth_image)
+    def wait_frame(self, cam, timeout):
+        # frames of the camera being calibrated
+        return self.cam.wait_frame(False, timeout)
+
+    def next_dot(self):
+        self.index += 1
+        if self.index == len(self.points):
+            self.cam.do_lookup_table()
+            self.cam.write_lookup_table()
+            return self.next_camera()
+        self.disp.clear()
+        self.phase = 'hide'
+        self.sched.call_later(self.conf.calib_timeout, 'timeout')
+        return None
+
+    def on_timer(self, name):
+        vid_x, vid_y = self.points[self.index]
+        if self.phase == 'show':
+            print('Warning: dot at ' + str(vid_x) + ', ' + str(vid_y) + ' not found')
+            return self.next_dot()
+        if self.phase == 'hide':
+            # show it anyway, as the blocking version did
+            self.show_dot()
+        return None
+
+    def show_dot(self):
+        vid_x, vid_y = self.points[self.index]
+        self.disp.add_button(self.offset[0] + vid_x, self.offset[1] + vid_y, 20, (255, 255, 255))
+        self.phase = 'show'
+        self.sched.cancel('timeout')
+        self.sched.call_later(self.conf.calib_timeout, 'timeout')
+
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        conf, proc = self.conf, self.proc
+        if self.phase == 'settle':
+            self.wait -= 1
+            if self.wait <= 0:
+                self.phase = 'background'
+            return None
+        if self.phase in ('background', 'burst'):
+            self.stack.append(proc.grey(color_image))
+            if len(self.stack) < conf.calib_burst:
+                return None
+            stack = np.stack(self.stack)
+            self.stack = []
+            if self.phase == 'background':
+                # median over a burst of frames, uint8
+                self.background_image = np.median(stack, axis=0).astype(np.uint8)
+                return self.next_dot()
+            return self.located(*proc.burst_centroid(stack, conf, self.background_image))
+
+        visible = proc.dot_visible(color_image, conf, self.background_image)
+        if self.phase == 'hide' and not visible:
+            self.show_dot()
+        elif self.phase == 'show' and visible:
+            self.sched.cancel('timeout')
+            self.phase = 'burst'
+        return None
+
+    def located(self, cam_x, cam_y, img, diff):
+        vid_x, vid_y = self.points[self.index]
+        if self.conf.DEBUG:
+            # compressed snapshot of the burst, np.load gives img, diff and background
+            os.makedirs(self.conf.DEBUG_PATH, exist_ok=True)
+            outfile = 'dot_' + str(self.cam_index) + '_' + str(vid_x) + '_' + str(vid_y) + '.npz'
+            np.savez_compressed(self.conf.DEBUG_PATH + outfile, img=img, diff=diff, background=self.background_image)
+
+        if cam_x is not None:
+            self.cam.set_lookup_point(vid_x, vid_y, cam_x, cam_y)
+        return self.next_dot()
+
+
+# State 3 - Training
+class Training(StateBase):
+    # blank for settle_frames, target for settle_frames, then train_frames recorded frames per sample
+    frames = 'next'
 
-                # prepare videoframe
-                disp.update_streams(depth_colormap, color_image)
+    def start(self):
+        conf = self.conf
+        self.proc = self.res.get('proc')
+        self.dataset = self.res.get('dataset')
+        self.roi = self.cam.roi
+        self.proc.set_roi(self.roi)
+        self.c = conf.sampling_reduction
+        import Calibration
+        self.res_h, self.res_w = Calibration.crop_shape(self.roi, self.c)
+        self.background_img = None
+        self.counter = 0
+        self.dataset.start()
+        self.blank()
 
-                if disp.show() == 27:
-                    break
+    def blank(self):
+        self.disp.clear()
+        self.disp.add_static_text(str(self.counter), 50, 100, (0, 200, 0), 1)
+        self.phase = 'blank'
+        self.wait = self.conf.settle_frames
 
-        finally:
+    def target(self):
+        # the target is drawn inside the camera's own area, its lookup table covers nothing else
+        conf, region = self.cam.conf, self.conf.train_region
+        vid_x = rnd.randrange(100, conf.vid_w - 100)
+        vid_y = rnd.randrange(100, conf.vid_h - 100)
+        cam_pts = self.cam.query_lookup_table(vid_x, vid_y)
+        # consider roi and compression, keep the patch inside the cropped image
+        self.cam_x = min(max(int((cam_pts[1] - self.roi[0]) / self.c), region), self.res_w - region)
+        self.cam_y = min(max(int((cam_pts[0] - self.roi[1]) / self.c), region), self.res_h - region)
+        offset_x, offset_y = conf.vid_offset
+        self.disp.add_button(offset_x + vid_x, offset_y + vid_y, 60, (0, 0, 200))
+        # record straight into the dataset shard, in the shared projector space
+        self.patches, vid, cam_xy, self.timestamps = self.dataset.sample()
+        vid[:] = (offset_x + vid_x, offset_y + vid_y)
+        # stored in reduced full frame coordinates
+        cam_xy[:] = (self.roi[0] // self.c + self.cam_x, self.roi[1] // self.c + self.cam_y)
+        self.phase = 'target'
+        self.wait = self.conf.settle_frames
+        self.framecounter = 0
+
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        region = self.conf.train_region
+        if self.background_img is None:
+            # first frame, blank projection
+            self.background_img = self.proc.generate_background_from_image(depth_image)
+            return None
+        if self.phase in ('blank', 'target'):
+            self.wait -= 1
+            if self.wait > 0:
+                return None
+            if self.phase == 'blank':
+                self.target()
+            else:
+                self.phase = 'record'
+            return None
+
+        # camera timestamp [ms] in s
+        self.timestamps[self.framecounter] = timestamp / 1000
+        # get result images, where compression is applied and background is separated
+        result_img, result_depth_3d = self.proc.process_images(depth_image, color_image, self.background_img)
+        cam_x, cam_y = self.cam_x, self.cam_y
+        self.patches[self.framecounter] = result_depth_3d[cam_y-region:cam_y+region, cam_x-region:cam_x+region, 0]
+        self.framecounter += 1
+        if self.framecounter < self.conf.train_frames:
+            return None
+        # compressed and written on the dataset thread
+        self.dataset.commit()
+        self.counter += 1
+        if self.counter == self.conf.train_loops:
             return 0
+        self.blank()
+        return None
+
+    def exit(self):
+        self.dataset.stop()
+
+
+# State 4 - Live Stream
+class Livestream(StateBase):
+    frames = 'latest'
+
+    def start(self):
+        self.disp.clear()
+        self.tick.reset()
+
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        depth_colormap = self.disp.color_depth_from_image(depth_image)
+
+        # prepare videoframe
+        self.disp.update_streams(depth_colormap, color_image)
+        return None
+
+
+# State 5 - Record session for replay
+class Recording(StateBase):
+    # every frame is recorded, display is allowed to lag behind
+    frames = 'next'
+
+    def start(self):
+        self.rec = self.res.get('rec')
+        self.rec.start()
+        self.disp.clear()
+
+    def on_frame(self, depth_image, color_image, frame_number, timestamp):
+        self.rec.add(depth_image, color_image, frame_number, timestamp)
+        depth_colormap = self.disp.color_depth_from_image(depth_image)
+
+        # prepare videoframe
+        self.disp.update_streams(depth_colormap, color_image)
+        self.disp.update_info('recorded: ' + str(self.rec.frames) + ' dropped: ' + str(self.cam.dropped_frames))
+        return None
+
+    def exit(self):
+        self.rec.stop()
+
+
+def register(sched, res, conf, tick):
+    run = MultiProcessing if len(conf.cameras) > 1 else Processing
+    for state_id, handler in ((0, MainMenu), (1, run), (2, Calibrating), (3, Training),
+                              (4, Livestream), (5, Recording)):
+        sched.register(state_id, handler(sched, res, conf, tick))
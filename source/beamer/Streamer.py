@@ -0,0 +1,188 @@
+import collections
+import json
+import threading
+import time
+import numpy as np
+import cv2
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Streamer:
+    # http server for remote monitoring:
+    #   /stream.mjpg  the window as mjpeg, downscaled and at most stream_fps
+    #   /frame.jpg    the newest frame
+    #   /events       server sent events, 'touch', 'gesture' and 'state' as they happen, 'metrics' every second
+    #   /key/<k>      key press for a headless display
+    # publish downscales the window into the encoder's slot and returns, encoding runs on its own
+    # thread. every client sends the newest jpeg when it is ready for one, so a slow client
+    # misses frames and neither the encoder nor the capture loop ever waits for it.
+
+    boundary = 'frame'
+    event_history = 256
+
+    def __init__(self, conf, tick, disp):
+        self.tick = tick
+        self.disp = disp
+        self.host = conf.stream_host
+        self.port = conf.stream_port
+        self.period = 1.0 / conf.stream_fps
+        self.scale = conf.stream_scale
+        self.quality = conf.stream_quality
+
+        # the downscaled window, written by publish while pending is False, read by the encoder while it is True
+        self.size = (int(conf.vid_w * self.scale), int(conf.vid_h * self.scale))
+        self.slot = np.zeros((self.size[1], self.size[0], 3), np.uint8)
+        self.pending = False
+        self.last_publish = 0.0
+
+        # newest jpeg and its serial, replaced as a whole
+        self.cond = threading.Condition()
+        self.jpeg = None
+        self.serial = 0
+        # events with sequence numbers, the oldest fall out for clients that are too far behind
+        self.events = collections.deque(maxlen=self.event_history)
+        self.sequence = 0
+
+        self.running = False
+        self.encoder = None
+        self.server = None
+
+    def start(self):
+        self.running = True
+        self.encoder = threading.Thread(target=self.encode, name='stream-encoder', daemon=True)
+        self.encoder.start()
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='stream', daemon=True).start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.encoder is not None:
+            self.encoder.join()
+            self.encoder = None
+
+    def publish(self, img):
+        # called by the main loop, returns at once. frames are dropped above stream_fps and
+        # while the encoder is still busy with the last one
+        now = time.perf_counter()
+        if now - self.last_publish < self.period or self.pending:
+            return False
+        cv2.resize(img, self.size, dst=self.slot, interpolation=cv2.INTER_AREA)
+        with self.cond:
+            self.pending = True
+            self.cond.notify_all()
+        self.last_publish = now
+        return True
+
+    def event(self, kind, data):
+        with self.cond:
+            self.sequence += 1
+            self.events.append((self.sequence, kind, data))
+            self.cond.notify_all()
+
+    def encode(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or not self.running)
+                if not self.running:
+                    return
+            ok, jpeg = cv2.imencode('.jpg', self.slot, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+            with self.cond:
+                if ok:
+                    self.jpeg = jpeg.tobytes()
+                    self.serial += 1
+                self.pending = False
+                self.cond.notify_all()
+
+    def next_jpeg(self, seen, timeout):
+        # (serial, jpeg) newer than seen, None on timeout or stop
+        with self.cond:
+            self.cond.wait_for(lambda: self.serial > seen or not self.running, timeout)
+            if self.serial <= seen or not self.running:
+                return None
+            return self.serial, self.jpeg
+
+    def next_events(self, seen, timeout):
+        # events after sequence number seen, an empty list on timeout
+        with self.cond:
+            self.cond.wait_for(lambda: self.sequence > seen or not self.running, timeout)
+            return [e for e in self.events if e[0] > seen]
+
+    def handler(self):
+        streamer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    if self.path == '/stream.mjpg':
+                        self.send_mjpeg()
+                    elif self.path == '/frame.jpg':
+                        self.send_frame()
+                    elif self.path == '/events':
+                        self.send_events()
+                    elif self.path.startswith('/key/') and len(self.path) == 6:
+                        streamer.disp.press(ord(self.path[5]))
+                        self.send_body(b'ok\n', 'text/plain')
+                    else:
+                        self.send_error(404)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_body(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_frame(self):
+                frame = streamer.next_jpeg(0, 1.0)
+                if frame is None:
+                    self.send_error(503)
+                    return
+                self.send_body(frame[1], 'image/jpeg')
+
+            def send_mjpeg(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + streamer.boundary)
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                seen = 0
+                while streamer.running:
+                    frame = streamer.next_jpeg(seen, 1.0)
+                    if frame is None:
+                        continue
+                    seen, jpeg = frame
+                    self.wfile.write(('--' + streamer.boundary + '\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                                      str(len(jpeg)) + '\r\n\r\n').encode('ascii') + jpeg + b'\r\n')
+
+            def send_events(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                seen = streamer.sequence
+                next_metrics = 0.0
+                while streamer.running:
+                    lines = []
+                    for seen, kind, data in streamer.next_events(seen, 1.0):
+                        lines.append('event: ' + kind + '\ndata: ' + json.dumps(data) + '\n\n')
+                    if time.perf_counter() >= next_metrics:
+                        metrics = {'frames': streamer.tick.framecount, 'dropped': streamer.tick.dropped,
+                                   'stages': streamer.tick.summary}
+                        lines.append('event: metrics\ndata: ' + json.dumps(metrics) + '\n\n')
+                        next_metrics = time.perf_counter() + 1.0
+                    if lines:
+                        self.wfile.write(''.join(lines).encode('utf-8'))
+                        self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,26 +1,209 @@
+import json
+import threading
 import time
+from contextlib import contextmanager
 import numpy as np
 
-class Tick:
-    framecount = 0
-    info = ''
 
-    def __init__(self, num_of_tickers):
-        self.num_of_tickers = num_of_tickers
-        self.tsum = np.zeros(num_of_tickers - 1)
-        self.ticker = np.zeros(num_of_tickers)
+class StageTimer:
+    # reusable context manager / decorator for one named stage. the start time is per thread,
+    # the camera acquisition threads time the same stages concurrently
+
+    def __init__(self, tick, index):
+        self.tick = tick
+        self.index = index
+        self.local = threading.local()
+
+    def __enter__(self):
+        self.local.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tick.record(self.index, time.perf_counter() - self.local.start)
+        return False
+
+    def __call__(self, func):
+        def timed(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return timed
+
+
+class Startup:
+    # wall clock phases from process start to the first frame, phases may overlap (background warmup)
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, begin, time.perf_counter())
 
-    def tick(self, i):
-        if i >= self.num_of_tickers:
+    def add(self, name, begin, end):
+        with self.lock:
+            self.phases.append((name, begin - self.start, end - begin, threading.current_thread().name))
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.add(name, now, now)
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = ['startup phase            at [ms]  took [ms]  thread']
+        for name, begin, duration, thread in phases:
+            lines.append(name.ljust(24) + format(begin * 1000, '8.1f') + format(duration * 1000, '11.1f') + '  ' + thread)
+        return lines
+
+    def first_frame(self):
+        # time to first frame, reported once
+        if self.reported:
             return
-        self.ticker[i] = time.perf_counter()
+        self.mark('first frame')
+        self.reported = True
+        print('\n'.join(self.report()))
 
-    def update_info(self):
-        self.info = ''
+
+class Tick:
+    stages = ('acquire', 'align', 'background', 'process', 'touch', 'classify', 'colormap', 'compose', 'show')
+    quantiles = (50, 95, 99)
+
+    def __init__(self, conf, startup=None):
+        self.startup = startup if startup is not None else Startup()
+        self.window = conf.tick_window
+        self.refresh = conf.tick_refresh
+        self.frame_period = 1.0 / conf.fps
+
+        # ring of samples per stage plus one row for the whole frame, in seconds
+        self.samples = np.zeros((len(self.stages) + 1, self.window))
+        self.count = np.zeros(len(self.stages) + 1, np.int64)
+        self.timers = {name: StageTimer(self, i) for i, name in enumerate(self.stages)}
+        self.lock = threading.Lock()
+
+        self.framecount = 0
+        self.dropped = 0
+        self.last_frame = None
+        self.summary = {}
+        self.info = []
+
+        self.export_file = None
+        if conf.tick_export:
+            self.export_file = open(conf.tick_export, 'a')
+            self.export_csv = conf.tick_export.endswith('.csv')
+            if self.export_csv and self.export_file.tell() == 0:
+                self.export_file.write('time;stage;count;p50;p95;p99;max\n')
+        self.server = None
+        if conf.tick_port:
+            self.serve(conf.tick_port)
+
+    def stage(self, name):
+        return self.timers[name]
+
+    def record(self, index, seconds):
+        with self.lock:
+            self.samples[index, self.count[index] % self.window] = seconds
+            self.count[index] += 1
+
+    def frame(self):
+        # call once per loop iteration, counts camera frames missed against the configured fps
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            period = now - self.last_frame
+            self.record(len(self.stages), period)
+            self.dropped += max(0, int(period / self.frame_period + 0.5) - 1)
+        if self.last_frame is None:
+            self.startup.first_frame()
+        self.last_frame = now
         self.framecount += 1
-        for i in range(0, self.num_of_tickers - 1):
-            self.tsum[i] += self.ticker[i+1] - self.ticker[i]
-            self.info += '[' + str(i) + ']: ' + str(int(self.tsum[i]/self.framecount*1000)) + 'ms '
+        if self.framecount % self.refresh == 0:
+            self.update_info()
+
+    def reset(self):
+        self.count[:] = 0
+        self.framecount = 0
+        self.dropped = 0
+        self.last_frame = None
+
+    def percentiles(self, index):
+        n = min(self.count[index], self.window)
+        if n == 0:
+            return None
+        values = np.percentile(self.samples[index, 0:n], self.quantiles)
+        return [float(v) for v in values] + [float(self.samples[index, 0:n].max())]
+
+    def update_info(self):
+        # built aside and replaced as a whole, the http threads read summary and info while this runs
+        summary = {}
+        for i, name in enumerate(self.stages + ('frame',)):
+            values = self.percentiles(i)
+            if values is not None:
+                summary[name] = [int(self.count[i])] + values
+
+        info = ['frames: ' + str(self.framecount) + '  dropped: ' + str(self.dropped)]
+        for name, values in summary.items():
+            info.append(name.ljust(10) + ' ' + ' '.join(
+                label + ' ' + format(v * 1000, '.1f') for label, v in zip(('p50', 'p95', 'p99', 'max'), values[1:])))
+        self.summary = summary
+        self.info = info
+
+        if self.export_file is not None:
+            self.export()
 
     def get_info(self):
-        return self.info
\ No newline at end of file
+        return self.info
+
+    def export(self):
+        now = time.time()
+        if self.export_csv:
+            for name, values in self.summary.items():
+                self.export_file.write(';'.join([format(now, '.3f'), name] + [str(v) for v in values]) + '\n')
+        else:
+            self.export_file.write(json.dumps({'time': now, 'dropped': self.dropped, 'stages': self.summary}) + '\n')
+        self.export_file.flush()
+
+    def prometheus(self):
+        lines = ['# TYPE beamer_stage_seconds summary']
+        for name, values in self.summary.items():
+            for q, v in zip(self.quantiles, values[1:4]):
+                lines.append('beamer_stage_seconds{stage="' + name + '",quantile="' + str(q / 100) + '"} ' + str(v))
+            lines.append('beamer_stage_seconds_count{stage="' + name + '"} ' + str(values[0]))
+        lines.append('# TYPE beamer_frames_total counter')
+        lines.append('beamer_frames_total ' + str(self.framecount))
+        lines.append('# TYPE beamer_dropped_frames_total counter')
+        lines.append('beamer_dropped_frames_total ' + str(self.dropped))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        # prometheus text endpoint on localhost
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        tick = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tick.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        if self.export_file is not None:
+            self.export_file.close()
+            self.export_file = None
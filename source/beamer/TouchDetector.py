@@ -0,0 +1,110 @@
+import numpy as np
+import cv2
+
+import Calibration
+import Dtypes
+
+
+class TouchDetector:
+    # finds fingers above the background plane in the processed depth image and
+    # turns hits on registered buttons into debounced press / release events
+
+    def __init__(self, conf):
+        self.compression = conf.sampling_reduction
+        self.roi = Calibration.full_roi(conf.img_h, conf.img_w)
+        self.min_height = conf.touch_min_height
+        self.max_height = conf.touch_max_height
+        self.min_area = conf.touch_min_area
+        self.press_frames = conf.touch_press_frames
+        self.release_frames = conf.touch_release_frames
+
+        self.buttons = []
+        self.centers = np.zeros((0, 2), Dtypes.coord)
+        self.radii = np.zeros(0, Dtypes.coord)
+        self.pressed = np.zeros(0, bool)
+        self.streak = np.zeros(0, np.int64)
+
+        self.height = None
+        self.mask = None
+        self.blobs = np.zeros((0, 3), Dtypes.coord)
+        self.points = np.zeros((0, 2), Dtypes.coord)
+
+    def set_roi(self, roi):
+        # result_depth is cropped to this camera region
+        self.roi = roi
+
+    def add_button(self, name, cx, cy, r):
+        # projector coordinates, same as Display.add_button
+        self.buttons.append(name)
+        self.centers = np.vstack((self.centers, np.array([(cx, cy)], Dtypes.coord)))
+        self.radii = np.append(self.radii, Dtypes.coord(r))
+        self.pressed = np.append(self.pressed, False)
+        self.streak = np.append(self.streak, 0)
+
+    def clear_buttons(self):
+        self.buttons = []
+        self.centers = np.zeros((0, 2), Dtypes.coord)
+        self.radii = np.zeros(0, Dtypes.coord)
+        self.pressed = np.zeros(0, bool)
+        self.streak = np.zeros(0, np.int64)
+
+    def reset(self):
+        self.pressed[:] = False
+        self.streak[:] = 0
+
+    def allocate(self, shape):
+        if self.height is None or self.height.shape != shape:
+            self.height = np.zeros(shape, Dtypes.depth)
+            self.mask = np.zeros(shape, np.uint8)
+
+    def detect(self, result_depth, bg_image):
+        # blobs as rows of (cam_x, cam_y, area) in full resolution camera pixels
+        Dtypes.check('result_depth', result_depth, Dtypes.depth)
+        Dtypes.check('bg_image', bg_image, Dtypes.depth)
+        self.allocate(result_depth.shape)
+        # saturated, pixels behind the background are 0 and never in the height band
+        cv2.subtract(bg_image, result_depth, dst=self.height)
+        cv2.inRange(self.height, self.min_height, self.max_height, dst=self.mask)
+        # zero depth is background or no reading
+        self.mask[result_depth == 0] = 0
+
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(self.mask, connectivity=8)
+        # label 0 is the background
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        keep = areas >= self.min_area
+        blobs = np.empty((np.count_nonzero(keep), 3), Dtypes.coord)
+        blobs[:, 0:2] = centroids[1:][keep] * self.compression + self.roi[0:2]
+        blobs[:, 2] = areas[keep] * self.compression ** 2
+        self.blobs = blobs
+        return blobs
+
+    def update(self, result_depth, bg_image, cam):
+        # returns a list of (button, 'press' | 'release', vid_x, vid_y)
+        blobs = self.detect(result_depth, bg_image)
+        return self.hit(cam.camera_to_projector(blobs[:, 0:2]))
+
+    def hit(self, points):
+        # debounced button state from blobs in projector coordinates, events as in update
+        self.points = points = Dtypes.coords(points)
+
+        # every blob against every button
+        dist = np.linalg.norm(points[:, np.newaxis, :] - self.centers[np.newaxis, :, :], axis=2)
+        inside = dist <= self.radii[np.newaxis, :]
+        hit = inside.any(axis=0)
+
+        # consecutive frames in the opposite of the current state
+        changing = hit != self.pressed
+        self.streak = np.where(changing, self.streak + 1, 0)
+        limit = np.where(self.pressed, self.release_frames, self.press_frames)
+        flip = changing & (self.streak >= limit)
+        self.pressed ^= flip
+        self.streak[flip] = 0
+
+        events = []
+        for i in np.flatnonzero(flip):
+            if self.pressed[i]:
+                j = int(np.argmin(dist[:, i]))
+                events.append((self.buttons[i], 'press', float(points[j, 0]), float(points[j, 1])))
+            else:
+                events.append((self.buttons[i], 'release', float(self.centers[i, 0]), float(self.centers[i, 1])))
+        return events
@@ -1,47 +1,38 @@
-import Camera
-import Processors
-import Display
-import States
 import Tick
-import Config
 
+startup = Tick.Startup()
 
-def main():
-    # flow control
-    STATE = 0
+import Config
+import States
+import Resources
+import Scheduler
 
-    # instances
-    conf = Config.Config()
-    cam = Camera.Camera(conf)
-    proc = Processors.Processors(conf)
-    disp = Display.Display(conf)
-    states = States.States()
-    tick = Tick.Tick(4)
 
-    # Start streaming
-    cam.start()
-    disp.start()
+def main():
+    # instances, everything heavy is created on first use by res
+    with startup.phase('config'):
+        conf = Config.Config()
+        tick = Tick.Tick(conf, startup)
+        res = Resources.Resources(conf, tick)
+        sched = Scheduler.Scheduler(res, tick)
+        States.register(sched, res, conf, tick)
+    startup.mark('imports done')
+
+    # menu first, camera and calibration tables load meanwhile
+    res.get('disp')
+    res.warm('cams')
+    startup.mark('menu')
 
     try:
-        while True:
-            # state machine
-            if STATE == 0:
-                STATE = states.main_menu(disp, cam)
-            if (STATE == 1) & cam.status:
-                STATE = states.processing(disp, cam, proc, tick, conf)
-            if (STATE == 2) & cam.status:
-                STATE = states.calibration(disp, cam, proc, conf)
-            if (STATE == 3) & cam.status:
-                STATE = states.training(disp, proc, cam, conf)
-            if (STATE == 4) & cam.status:
-                STATE = states.livestream(disp, cam, proc)
-            if STATE == -1:
-                break
+        # state machine, runs until the menu exits
+        sched.run(0)
 
     finally:
         # Stop streaming
-        disp.stop()
-        cam.stop()
+        res.stop()
+        tick.stop()
+        if not startup.reported:
+            print('\n'.join(startup.report()))
 
 
 if __name__ == "__main__":